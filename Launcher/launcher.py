@@ -5,6 +5,8 @@ import zipfile
 import subprocess
 import socket
 import argparse
+import threading
+import concurrent.futures
 
 import PySimpleGUI as sg
 
@@ -14,85 +16,257 @@ from Updater import settings
 from Updater import messages
 from Updater import registry
 from Updater import updater
+from Updater import delta
+from Updater import manifest
+from Updater import staging
+from Updater import installed
+
+
+class ParallelExtractor(object):
+    # Extracts members of a zip on a pool of threads. Decompression and writing release the GIL,
+    # so the threads run on all the cores. The threads share the zip handler, which only locks the reads
+    # of the compressed data (so the central directory is parsed once).
+    def __init__(self, zip_handler, path, installed_manifest):
+        self.zip_handler = zip_handler
+        self.path = path
+        self.installed_manifest = installed_manifest
+        self.lock = threading.Lock()
+        self.extracted_size = 0
+        self.canceled = threading.Event()
+
+    def extract(self, members):
+        for member in members:
+            if self.canceled.is_set():
+                return
+
+            try:
+                file_path = self.zip_handler.extract(member, path=self.path)
+            except FileExistsError:
+                # Another thread created a folder of the member meanwhile
+                file_path = self.zip_handler.extract(member, path=self.path)
+
+            with self.lock:
+                self.installed_manifest.record(member, file_path)
+                self.extracted_size += member.file_size
+
+
+def get_extraction_tasks(members):
+    # Groups small members into tasks of about EXTRACTION_BATCH_SIZE bytes, a large member is a task of its own.
+    # The large members are started first (largest first), so none of them ends up running alone at the end.
+    # The batches keep the order of the zip, so it is still read mostly sequentially.
+    large_members = []
+    batches = []
+    batch = []
+    batch_size = 0
+    for member in members:
+        if member.file_size >= settings.EXTRACTION_BATCH_SIZE:
+            large_members.append(member)
+            continue
+
+        batch.append(member)
+        batch_size += member.file_size
+        if batch_size >= settings.EXTRACTION_BATCH_SIZE or len(batch) >= settings.EXTRACTION_BATCH_MEMBERS:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+
+    if len(batch) != 0:
+        batches.append(batch)
+
+    large_members.sort(key=lambda member: member.file_size, reverse=True)
+    return [[member] for member in large_members] + batches
 
 
 def progressive_extract(zip_handler, silent):
+    # Only the members that differ from the installed files are extracted
+    installed_manifest = installed.InstalledManifest.load(settings.INSTALLED_MANIFEST_PATH)
+    members = zip_handler.infolist()
+    changed_members = installed_manifest.get_changed_members(members, settings.PROGRAM_PATH)
+
     # Calculates the total uncompressed size
-    uncompress_size = sum((file.file_size for file in zip_handler.infolist()))
-    
-    extracted_size = 0
-    for file in zip_handler.infolist():
-        # Extracts the current file
-        zip_handler.extract(file, path=settings.PROGRAM_PATH)
-
-        # Calculates the total extracted size
-        extracted_size += file.file_size
-        
-        # Updates the progress bar
-        should_continue = True
-        if not silent:
-            should_continue = sg.one_line_progress_meter('Updating...', extracted_size, uncompress_size,
-                                                         "extraction_bar",
-                                                         "Applying update...", orientation="horizontal",
-                                                         no_titlebar=True, grab_anywhere=True)
-                            
-        # Checks if finished or canceled
-        if extracted_size >= uncompress_size:
-            return True
-        if not should_continue:
-            # The user has pressed the cancel button
-            result = sg.popup_yes_no("Canceling the update might break your program and render it useless.\nAre you sure you want to cancel?", title="Are you sure?")
-            if result == "Yes":
-                return False
-    
+    uncompress_size = sum((file.file_size for file in changed_members))
+
+    extractor = ParallelExtractor(zip_handler, settings.PROGRAM_PATH, installed_manifest)
+    workers = settings.EXTRACTION_WORKERS or os.cpu_count() or 1
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set(executor.submit(extractor.extract, task) for task in get_extraction_tasks(changed_members))
+            try:
+                while len(pending) != 0:
+                    # Wakes up periodically, so the progress bar keeps responding while the workers extract
+                    done, pending = concurrent.futures.wait(pending, timeout=0.1,
+                                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        # Raises the errors of the workers (a PermissionError, for example)
+                        future.result()
+
+                    # Updates the progress bar
+                    should_continue = True
+                    if not silent:
+                        should_continue = sg.one_line_progress_meter('Updating...', extractor.extracted_size,
+                                                                     uncompress_size, "extraction_bar",
+                                                                     "Applying update...", orientation="horizontal",
+                                                                     no_titlebar=True, grab_anywhere=True)
+
+                    # Checks if canceled
+                    if not should_continue and len(pending) != 0:
+                        # The user has pressed the cancel button
+                        result = sg.popup_yes_no("Canceling the update might break your program and render it useless.\nAre you sure you want to cancel?", title="Are you sure?")
+                        if result == "Yes":
+                            return False
+            finally:
+                # Stops the workers after their current member (when canceled or failed)
+                extractor.canceled.set()
+                for future in pending:
+                    future.cancel()
+
+        # Deletes the installed files that were dropped from the release
+        installed_manifest.remove_dropped_files(members, settings.PROGRAM_PATH)
+    finally:
+        # Even when canceled, so the files that were extracted are not extracted again
+        installed_manifest.save()
+
     return True
 
 
-def progressive_copy(src, dest, silent):
-    result = True
-    chunk_size = 1024 * 1024
-    file_size = os.stat(src).st_size
-    total_bytes = 0
-
-    src = open(src, "rb")
-    dest = open(dest, "wb")
-
-    while total_bytes < file_size:
-        chunk = src.read(chunk_size)
-        dest.write(chunk)
-        total_bytes += len(chunk)
-        should_continue = True
-        if not silent:
-            should_continue = sg.one_line_progress_meter('Updating...', total_bytes, file_size,
-                                                         "copying_bar",
-                                                         "Extracting update...", orientation="horizontal",
-                                                         no_titlebar=True, grab_anywhere=True)
-        # Checks if finished or canceled
-        if total_bytes >= file_size:
-            break
-        if not should_continue:
-            # The user has pressed the cancel button
-            output = sg.popup_yes_no(
-                "Canceling the update might break your program and render it useless.\nAre you sure you want to cancel?",
-                title="Are you sure?")
-            if output == "Yes":
-                result = False
-                break
-
-    src.close()
-    dest.close()
+def progressive_patch(zip_handler, delta_manifest, silent):
+    # Returns False if the user canceled, and None if a file could not be patched (the full update is needed)
+    members = delta.get_members(delta_manifest)
+    installed_manifest = installed.InstalledManifest.load(settings.INSTALLED_MANIFEST_PATH)
+
+    try:
+        for patched_count, member_name in enumerate(members, start=1):
+            # The patched file is not the member of the last full update anymore, it is extracted next time
+            installed_manifest.forget(member_name)
+
+            # Patches the current file
+            if not delta.apply_member(zip_handler, delta_manifest, member_name, settings.PROGRAM_PATH):
+                error_message = f"Failed to patch {member_name}. The installed file does not match version {delta_manifest['base']}."
+                if silent:
+                    print(error_message)
+                else:
+                    sg.popup_error(error_message, title="Error")
+                return None
+
+            # Updates the progress bar
+            should_continue = True
+            if not silent:
+                should_continue = sg.one_line_progress_meter('Updating...', patched_count, len(members),
+                                                             "patching_bar",
+                                                             "Applying update...", orientation="horizontal",
+                                                             no_titlebar=True, grab_anywhere=True)
+
+            if not should_continue and patched_count < len(members):
+                # The user has pressed the cancel button
+                result = sg.popup_yes_no("Canceling the update might break your program and render it useless.\nAre you sure you want to cancel?", title="Are you sure?")
+                if result == "Yes":
+                    return False
+    finally:
+        installed_manifest.save()
+
+    return True
+
+
+def progressive_activate(staging_path, zip_handler, silent):
+    # The service extracted the update while downloading it, only move the staged files that differ from
+    # the installed files into place
+    installed_manifest = installed.InstalledManifest.load(settings.INSTALLED_MANIFEST_PATH)
+    members = zip_handler.infolist()
+    changed_members = installed_manifest.get_changed_members(members, settings.PROGRAM_PATH)
+
+    try:
+        for activated_count, member in enumerate(changed_members, start=1):
+            if member.is_dir():
+                os.makedirs(installed.get_file_path(settings.PROGRAM_PATH, member.filename), exist_ok=True)
+            else:
+                relative_path = os.path.join(*member.filename.split("/"))
+                file_path = staging.activate_file(staging_path, relative_path, settings.PROGRAM_PATH)
+                installed_manifest.record(member, file_path)
+
+            # Updates the progress bar
+            should_continue = True
+            if not silent:
+                should_continue = sg.one_line_progress_meter('Updating...', activated_count, len(changed_members),
+                                                             "activation_bar",
+                                                             "Applying update...", orientation="horizontal",
+                                                             no_titlebar=True, grab_anywhere=True)
+
+            if not should_continue and activated_count < len(changed_members):
+                # The user has pressed the cancel button
+                result = sg.popup_yes_no("Canceling the update might break your program and render it useless.\nAre you sure you want to cancel?", title="Are you sure?")
+                if result == "Yes":
+                    return False
+
+        # Deletes the installed files that were dropped from the release
+        installed_manifest.remove_dropped_files(members, settings.PROGRAM_PATH)
+    finally:
+        installed_manifest.save()
+
+    return True
+
+
+def activate_staged_update(staging_path, update_filepath, silent):
+    # Returns None if the staged files can't be used, and the update file should be extracted instead
+    try:
+        with zipfile.ZipFile(update_filepath, "r") as zip_handler:
+            result = progressive_activate(staging_path, zip_handler, silent)
+    except PermissionError:
+        # probably program is running or permission is denied
+        error_message = "Failed to update due to PermissionError. The program might be running or launcher has insufficient permissions."
+        if silent:
+            print(error_message)
+        else:
+            sg.popup_error(error_message, title="Error")
+        return False
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+    if result:
+        staging.remove_staging(staging_path)
     return result
 
 
+def link_installed_update(update_filepath):
+    # Keeps UPDATE_PATH as the update that is installed, a hard link to the downloaded file instead of a copy of it
+    temp_path = f"{settings.UPDATE_PATH}.tmp"
+    try:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        os.link(update_filepath, temp_path)
+        os.replace(temp_path, settings.UPDATE_PATH)
+    except OSError:
+        # Hard links are not supported on this volume, an outdated update file would only be misleading
+        try:
+            os.remove(settings.UPDATE_PATH)
+        except OSError:
+            pass
+
+
 def cleanup_old_updates():
-    current_version_registry = updater.Version.get_current_version().get_update_registry_path()
+    current_version = updater.Version.get_current_version()
+    current_version_registries = [current_version.get_update_registry_path(),
+                                  current_version.get_delta_registry_path(),
+                                  current_version.get_delta_base_registry_path(),
+                                  current_version.get_staging_registry_path()]
     all_sub_values = registry.get_all_sub_values(settings.REGISTRY_PATH)
-    update_prefix = settings.UPDATE_REGISTRY_FORMAT.format("")
+    update_prefixes = (settings.UPDATE_REGISTRY_FORMAT.format(""), settings.DELTA_REGISTRY_FORMAT.format(""),
+                       settings.STAGING_REGISTRY_FORMAT.format(""))
     all_sub_values = [settings.REGISTRY_PATH + "\\" + v for v in all_sub_values]
-    all_sub_values = [v for v in all_sub_values if v.startswith(update_prefix) and v != current_version_registry]
+    all_sub_values = [v for v in all_sub_values if v.startswith(update_prefixes) and v not in current_version_registries]
 
     for update_registry in all_sub_values:
+        if update_registry.endswith("_base"):
+            # Holds a version, not a file
+            registry.delete(update_registry)
+            continue
+
         file = registry.get_value(update_registry)
+        if update_registry.startswith(settings.STAGING_REGISTRY_FORMAT.format("")):
+            # Holds a folder of staged files
+            staging.remove_staging(file)
+            registry.delete(update_registry)
+            continue
+
         try:
             os.remove(file)
         except PermissionError:
@@ -101,31 +275,51 @@ def cleanup_old_updates():
         except FileNotFoundError:
             # File appears to be missing, should delete the registry...
             pass
+
+        try:
+            os.remove(manifest.get_manifest_path(file))
+        except OSError:
+            # The manifest is useless without the update, it will be overwritten if this version is downloaded again
+            pass
         registry.delete(update_registry)
 
 
 def update(update_file_path, silent):
+    # Returns False if the update was canceled or failed, and None if it can't be applied to the installed files
     try:
         update_file = zipfile.ZipFile(update_file_path, "r")
-    except zipfile.BadZipFile:
+    except (OSError, zipfile.BadZipFile):
         error_message = "Invalid update file."
         if silent:
             print(error_message)
         else:
             sg.popup_error(error_message, title="Error")
-        return False
+        return None
     
-    # Extracts the update
-    try:
-        result = progressive_extract(update_file, silent)
-    except PermissionError:
-        # probably program is running or permission is denied
-        error_message = "Failed to update due to PermissionError. The program might be running or launcher has insufficient permissions."
-        if silent:
-            print(error_message)
-        else:
-            sg.popup_error(error_message, title="Error")
-        return False
+    # Extracts the update (closing the file before returning, so a broken update can be deleted)
+    with update_file:
+        try:
+            if delta.is_delta(update_file):
+                delta_manifest = delta.read_manifest(update_file)
+                installed_version = updater.Version.get_installed_version()
+                if delta_manifest["base"] != str(installed_version):
+                    error_message = f"The update patches version {delta_manifest['base']}, but version {installed_version} is installed."
+                    if silent:
+                        print(error_message)
+                    else:
+                        sg.popup_error(error_message, title="Error")
+                    return None
+                result = progressive_patch(update_file, delta_manifest, silent)
+            else:
+                result = progressive_extract(update_file, silent)
+        except PermissionError:
+            # probably program is running or permission is denied
+            error_message = "Failed to update due to PermissionError. The program might be running or launcher has insufficient permissions."
+            if silent:
+                print(error_message)
+            else:
+                sg.popup_error(error_message, title="Error")
+            return False
     return result
 
 
@@ -135,11 +329,7 @@ def query_server():
         type=messages.MessageType.REQUEST_UPDATE,
         crc32=0
     )
-    request_update_message = messages.REQUEST_UPDATE_MESSAGE.build(request_update_dict)
-
-    # Updates the crc
-    request_update_dict["crc32"] = messages.calculate_crc(request_update_message)
-    request_update_message = messages.REQUEST_UPDATE_MESSAGE.build(request_update_dict)
+    request_update_message = messages.build_message(messages.REQUEST_UPDATE_MESSAGE, request_update_dict)
 
     ip_address = registry.get_value(settings.UPDATING_SERVER_REGISTRY)
     port = registry.get_value(settings.PORT_REGISTRY)
@@ -154,39 +344,84 @@ def query_server():
     except socket.error:
         print("Error: Failed to check for update")
     finally:
-        sender.shutdown(2)
         sender.close()
 
 
+def request_full_update(version):
+    # Forgets the delta of the version, so the service downloads the full update of it instead.
+    # The current version goes back to the installed one, as if the version was never received.
+    delta_registry = version.get_delta_registry_path()
+    delta_path = registry.get_value(delta_registry)
+    with registry.batch():
+        registry.set_value(settings.SKIP_DELTA_REGISTRY, str(version))
+        registry.delete(delta_registry)
+        if registry.exists(version.get_delta_base_registry_path()):
+            registry.delete(version.get_delta_base_registry_path())
+        updater.Version.get_installed_version().update_current_version()
+
+    for path in [delta_path, manifest.get_manifest_path(delta_path)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # The service downloads the version again anyway
+            print(f"Failed to delete {path}")
+
+    query_server()
+
+
 def install_update(silent):
     # Checks if an update is available
     if updater.Version.is_updated():
         return "ERROR: No update is available."
 
+    # Applies the delta, if one was downloaded for the installed version
+    current_version = updater.Version.get_current_version()
+    delta_registry = current_version.get_delta_registry_path()
+    version_registry = current_version.get_update_registry_path()
+    if registry.exists(delta_registry):
+        result = update(registry.get_value(delta_registry), silent)
+        if result:
+            current_version.update_installed_version()
+            return "Update installed successfully!"
+        if result is not None:
+            # Canceled or failed, the program is left as it is
+            return
+        if not registry.exists(version_registry):
+            # Some files were probably patched already, only the full update can fix them
+            request_full_update(current_version)
+            return "ERROR: The delta update could not be applied. The full update is being downloaded."
+
+    # Moves the staged files into place, if the service staged the update while downloading it
+    staging_registry = current_version.get_staging_registry_path()
+    if registry.exists(staging_registry):
+        staging_path = registry.get_value(staging_registry)
+        result = None
+        if os.path.isdir(staging_path) and registry.exists(version_registry):
+            # The members of the update tell which staged files changed
+            result = activate_staged_update(staging_path, registry.get_value(version_registry), silent)
+        if result is not None:
+            if not result:
+                # Canceled (the rest of the staged files are moved next time) or failed
+                return
+            registry.delete(staging_registry)
+            link_installed_update(registry.get_value(version_registry))
+            current_version.update_installed_version()
+            return "Update installed successfully!"
+        registry.delete(staging_registry)
+
     # Get the path of the update file
-    version_registry = updater.Version.get_current_version().get_update_registry_path()
+    if not registry.exists(version_registry):
+        return "ERROR: The full update is not available."
     update_filepath = registry.get_value(version_registry)
+    if not os.path.exists(update_filepath):
+        return "ERROR: The full update is not available."
 
-    # Replace the old update file with the new one
-    error_message = None
-    try:
-        if not progressive_copy(update_filepath, settings.UPDATE_PATH, silent):
-            # Update was canceled by the user
-            return
-    except PermissionError:
-        error_message = f"Failed to replace update file {settings.UPDATE_PATH}. Insufficient permission or file is locked."
-    except OSError:
-        error_message = f"Failed to replace update file {settings.UPDATE_PATH}. Unknown OS Error."
-
-    if error_message:
-        if silent:
-            print(error_message)
-        else:
-            sg.popup_error(error_message, title="Error")
-        return
+    # Extracts the update straight from the downloaded file, the service verified it while downloading it
+    if update(update_filepath, silent):
+        link_installed_update(update_filepath)
 
-    # Extracts the update
-    if update(settings.UPDATE_PATH, silent):
         # Version was updated! Update the registry
         updater.Version.get_current_version().update_installed_version()
         return "Update installed successfully!"
@@ -0,0 +1,219 @@
+import io
+import os
+import struct
+import shutil
+import zipfile
+import tempfile
+import collections
+import concurrent.futures
+
+from Updater import settings
+from Updater import delta
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# The time of all the members, so the same files always make the same update
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Members that are encrypted or followed by a data descriptor are never copied
+ENCRYPTED_FLAG = 0x01
+DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def get_compress_type(file_path):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension in settings.STORED_EXTENSIONS:
+        # Already compressed (media, archives), compressing it again only costs time
+        return zipfile.ZIP_STORED
+    if extension in settings.LZMA_EXTENSIONS:
+        return zipfile.ZIP_LZMA
+    return zipfile.ZIP_DEFLATED
+
+
+def get_zip_info(file_path, member_name):
+    zip_info = zipfile.ZipInfo.from_file(file_path, member_name)
+    zip_info.date_time = FIXED_DATE_TIME
+    return zip_info
+
+
+def get_file_hash(file_path):
+    # Returns the hash (HASH_MODULE) of a file, as the manifest of the update keeps it
+    file_hash = settings.HASH_MODULE()
+    with open(file_path, "rb") as source_file:
+        data = source_file.read(COPY_BUFFER_SIZE)
+        while data:
+            file_hash.update(data)
+            data = source_file.read(COPY_BUFFER_SIZE)
+    return file_hash.hexdigest()
+
+
+def get_data_offset(source, header_offset):
+    # Returns the offset of the data of a member, which follows its local header
+    source.seek(header_offset)
+    header = source.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    filename_length, extra_length = fields[-2:]
+    return header_offset + zipfile.sizeFileHeader + filename_length + extra_length
+
+
+def write_raw_member(zip_handler, zip_info, source, data_offset):
+    # zipfile can't write a member that was compressed beforehand: a local header is written for it, its data
+    # is copied as it is, and it is added to the central directory that is written when the zip is closed
+    zip_info.header_offset = zip_handler.fp.tell()
+    zip_handler.fp.write(zip_info.FileHeader())
+
+    source.seek(data_offset)
+    remaining = zip_info.compress_size
+    while remaining > 0:
+        data = source.read(min(remaining, COPY_BUFFER_SIZE))
+        if not data:
+            raise zipfile.BadZipFile(f"Member {zip_info.filename} is truncated")
+        zip_handler.fp.write(data)
+        remaining -= len(data)
+
+    zip_handler.filelist.append(zip_info)
+    zip_handler.NameToInfo[zip_info.filename] = zip_info
+    zip_handler.start_dir = zip_handler.fp.tell()
+
+
+class CompressedMember(object):
+    # A file that was compressed on its own, as the single member of a zip (kept in memory, or in a temporary file
+    # when it is large). The compressors of zipfile are used, so the launcher can extract anything that is written.
+    def __init__(self, file_path, member_name, compress_type):
+        self.zip_info = get_zip_info(file_path, member_name)
+        self.buffer = io.BytesIO() if self.zip_info.file_size <= settings.COMPRESSION_SPOOL_SIZE \
+            else tempfile.TemporaryFile()
+        with zipfile.ZipFile(self.buffer, "w") as member_zip:
+            if isinstance(self.buffer, io.BytesIO):
+                # A single call compresses the whole file, without holding the GIL
+                with open(file_path, "rb") as member_file:
+                    member_zip.writestr(self.zip_info, member_file.read(), compress_type=compress_type)
+            else:
+                self.zip_info.compress_type = compress_type
+                with open(file_path, "rb") as member_file, member_zip.open(self.zip_info, "w") as member_data:
+                    shutil.copyfileobj(member_file, member_data, COPY_BUFFER_SIZE)
+        self.data_offset = get_data_offset(self.buffer, 0)
+
+    def write(self, zip_handler):
+        write_raw_member(zip_handler, self.zip_info, self.buffer, self.data_offset)
+
+    def close(self):
+        self.buffer.close()
+
+
+class ReusedMember(object):
+    # A file that did not change since the previous update, its compressed data is copied from it
+    def __init__(self, file_path, member_name, previous_file, previous_info):
+        self.zip_info = get_zip_info(file_path, member_name)
+        self.zip_info.compress_type = previous_info.compress_type
+        self.zip_info.flag_bits = previous_info.flag_bits
+        self.zip_info.CRC = previous_info.CRC
+        self.zip_info.compress_size = previous_info.compress_size
+        self.previous_file = previous_file
+        self.previous_info = previous_info
+
+    def write(self, zip_handler):
+        data_offset = get_data_offset(self.previous_file, self.previous_info.header_offset)
+        write_raw_member(zip_handler, self.zip_info, self.previous_file, data_offset)
+
+    def close(self):
+        pass
+
+
+def can_reuse(file_path, file_hash, compress_type, previous_info, previous_hash):
+    # The hash the manifest of the previous update keeps for every file tells if the file changed (a crc32 is too
+    # weak for that, a changed file could keep it). Members of another method are compressed again, so an update that
+    # was created before files were compressed doesn't keep them stored forever. A stored member with the fixed time
+    # was already found to be incompressible.
+    if previous_info is None or previous_info.is_dir() or previous_hash != file_hash:
+        return False
+    if previous_info.compress_type != compress_type and \
+            (previous_info.compress_type != zipfile.ZIP_STORED or previous_info.date_time != FIXED_DATE_TIME):
+        return False
+    if previous_info.flag_bits & (ENCRYPTED_FLAG | DATA_DESCRIPTOR_FLAG):
+        return False
+    return previous_info.file_size == os.path.getsize(file_path)
+
+
+def prepare_member(file_path, member_name, previous_file, previous_info, previous_hash):
+    # Returns the member and the hash of the file (for the manifest of the update)
+    file_hash = get_file_hash(file_path)
+    compress_type = get_compress_type(file_path)
+    if can_reuse(file_path, file_hash, compress_type, previous_info, previous_hash):
+        return ReusedMember(file_path, member_name, previous_file, previous_info), file_hash
+
+    member = CompressedMember(file_path, member_name, compress_type)
+    if compress_type != zipfile.ZIP_STORED and member.zip_info.compress_size >= member.zip_info.file_size:
+        # Compressing did not make it smaller, it is stored instead
+        member.close()
+        member = CompressedMember(file_path, member_name, zipfile.ZIP_STORED)
+    return member, file_hash
+
+
+def write_directory(path, zip_handler, previous_update_path=None, previous_files=None):
+    # Compresses the files on a pool of threads (zlib and lzma release the GIL), in the background,
+    # while the members that are ready are written into the zip in order.
+    # Files that did not change since the previous update (their hash is the one in previous_files, the hashes of the
+    # manifest of the previous update) are copied from it, without compressing them again.
+    # Members are sorted and their time is fixed, so the same files always make the same zip.
+    # Returns the number of files that were compressed and that were copied, and the hashes of the files.
+    entries = []
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            entry_path = os.path.join(root, name)
+            entries.append((delta.get_member_name(os.path.relpath(entry_path, path)), entry_path))
+    entries.sort()
+
+    previous_zip = previous_file = None
+    previous_infos = dict()
+    previous_files = previous_files if previous_files is not None else dict()
+    if previous_update_path is not None:
+        previous_zip = zipfile.ZipFile(previous_update_path, "r")
+        previous_file = open(previous_update_path, "rb")
+        previous_infos = {info.filename: info for info in previous_zip.infolist()}
+
+    counts = collections.Counter()
+    file_hashes = dict()
+    workers = settings.COMPRESSION_WORKERS or os.cpu_count() or 1
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            try:
+                for member_name, entry_path in entries:
+                    if os.path.isdir(entry_path):
+                        pending.append(entry_path)
+                    else:
+                        pending.append(executor.submit(prepare_member, entry_path, member_name, previous_file,
+                                                       previous_infos.get(member_name), previous_files.get(member_name)))
+
+                    # Only a few members are prepared ahead, so they don't all wait in memory
+                    while len(pending) >= workers * 4:
+                        write_entry(zip_handler, path, pending.popleft(), counts, file_hashes)
+
+                while len(pending) != 0:
+                    write_entry(zip_handler, path, pending.popleft(), counts, file_hashes)
+            finally:
+                for future in pending:
+                    if isinstance(future, concurrent.futures.Future):
+                        future.cancel()
+    finally:
+        if previous_zip is not None:
+            previous_file.close()
+            previous_zip.close()
+
+    return counts[CompressedMember], counts[ReusedMember], file_hashes
+
+
+def write_entry(zip_handler, path, entry, counts, file_hashes):
+    if isinstance(entry, str):
+        # A folder
+        zip_handler.writestr(get_zip_info(entry, os.path.relpath(entry, path)), b"")
+        return
+
+    member, file_hash = entry.result()
+    try:
+        member.write(zip_handler)
+    finally:
+        member.close()
+    counts[type(member)] += 1
+    file_hashes[member.zip_info.filename] = file_hash
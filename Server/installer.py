@@ -16,10 +16,13 @@ sys.path.append("..")
 
 from Updater import settings
 from Updater import registry
-from Updater import rsa_signing
 from Updater import updater
 from Updater import messages
+from Updater import delta
+from Updater import manifest
+from Updater import signing
 from Updater.messages import MessageType
+from Server import archive
 
 DEFAULT_SETTINGS_PATH = "settings.json"
 BUILD_DIRECTORY = "build"
@@ -60,17 +63,21 @@ def add_to_settings(values):
     return save_settings(current_settings)
 
 
-def zip_directory(path, zip_handler):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            relative_path = os.path.relpath(file_path, path)
-            zip_handler.write(file_path, relative_path)
+def zip_directory(path, zip_handler, previous_update_path=None, previous_files=None):
+    # Files are compressed in parallel, with a method that depends on their type.
+    # Files that did not change since the previous update are copied from it, without compressing them again.
+    return archive.write_directory(path, zip_handler, previous_update_path, previous_files)
 
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            relative_path = os.path.relpath(dir_path, path)
-            zip_handler.write(dir_path, relative_path)
+
+def get_previous_files(previous_filepath):
+    # Returns the hashes of the files of the previous update, which its manifest keeps (None if it doesn't)
+    try:
+        previous_manifest = manifest.Manifest.load(manifest.get_manifest_path(previous_filepath))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if previous_manifest.size != os.stat(previous_filepath).st_size or len(previous_manifest.files) == 0:
+        return None
+    return previous_manifest.files
 
 
 def generate_rsa_keys(display_keys=True):
@@ -88,9 +95,10 @@ def generate_rsa_keys(display_keys=True):
     # Adds the keys to registry
     if not registry.exists(settings.REGISTRY_PATH):
         registry.create_key(settings.REGISTRY_PATH)
-    registry.set_value(settings.RSA_MODULO_REGISTRY, hex(key_pair.n))
-    registry.set_value(settings.RSA_PUBLIC_REGISTRY, hex(key_pair.e))
-    registry.set_value(settings.RSA_PRIVATE_REGISTRY, hex(key_pair.d))
+    with registry.batch():
+        registry.set_value(settings.RSA_MODULO_REGISTRY, hex(key_pair.n))
+        registry.set_value(settings.RSA_PUBLIC_REGISTRY, hex(key_pair.e))
+        registry.set_value(settings.RSA_PRIVATE_REGISTRY, hex(key_pair.d))
 
     # Displays the keys to the user
     print("RSA keys were generated!")
@@ -100,6 +108,36 @@ def generate_rsa_keys(display_keys=True):
     return True
 
 
+def generate_ed25519_keys(display_keys=True):
+    private_key, public_key = signing.generate_ed25519_keys()
+
+    # Adds the public key to settings file
+    if not add_to_settings(dict(ED25519_PUBLIC_KEY=public_key)):
+        print(f"Failed to add ed25519 key to {DEFAULT_SETTINGS_PATH}")
+        return False
+
+    # Adds the keys to registry
+    if not registry.exists(settings.REGISTRY_PATH):
+        registry.create_key(settings.REGISTRY_PATH)
+    with registry.batch():
+        registry.set_value(settings.ED25519_PUBLIC_REGISTRY, public_key)
+        registry.set_value(settings.ED25519_PRIVATE_REGISTRY, private_key)
+
+    # Displays the keys to the user
+    print("Ed25519 keys were generated!")
+    print("")
+    if display_keys:
+        show_ed25519_keys()
+    return True
+
+
+def generate_keys(display_keys=True):
+    # Generates keys of the scheme messages are signed with
+    if signing.get_scheme() == signing.SignatureScheme.RSA:
+        return generate_rsa_keys(display_keys)
+    return generate_ed25519_keys(display_keys)
+
+
 def show_rsa_keys():
     print("RSA Modulo (n):")
     if registry.exists(settings.RSA_MODULO_REGISTRY):
@@ -123,6 +161,22 @@ def show_rsa_keys():
     return True
 
 
+def show_ed25519_keys():
+    print("Ed25519 Public Key:")
+    if registry.exists(settings.ED25519_PUBLIC_REGISTRY):
+        print(registry.get_value(settings.ED25519_PUBLIC_REGISTRY))
+    else:
+        print("Not available.")
+    print("")
+
+    print("Ed25519 Private Key:")
+    if registry.exists(settings.ED25519_PRIVATE_REGISTRY):
+        print(registry.get_value(settings.ED25519_PRIVATE_REGISTRY))
+    else:
+        print("Not available.")
+    return True
+
+
 def show_server_information():
     address_id = "Not available"
     if registry.exists(settings.ADDRESS_ID_REGISTRY):
@@ -158,8 +212,8 @@ def send_server_information(ip, port, spread=True):
     if not registry.exists(settings.ADDRESS_ID_REGISTRY):
         print(f"Address ID was not found in the registry! (Location: {settings.ADDRESS_ID_REGISTRY})")
         return False
-    if not registry.exists(settings.RSA_PRIVATE_REGISTRY):
-        print(f"RSA Private Key was not found in the registry! (Location: {settings.RSA_PRIVATE_REGISTRY})")
+    if not registry.exists(signing.get_private_key_registry()):
+        print(f"Private Key was not found in the registry! (Location: {signing.get_private_key_registry()})")
         return False
     address_id = registry.get_value(settings.ADDRESS_ID_REGISTRY)
 
@@ -176,25 +230,81 @@ def send_server_information(ip, port, spread=True):
 
     # Calculate signature of message
     try:
-        server_update_message = messages.SERVER_UPDATE_MESSAGE.build(server_update_dict)
-
-        # Update signature
-        server_update_dict["signature"] = messages.sign_message(server_update_message)
-        server_update_message = messages.SERVER_UPDATE_MESSAGE.build(server_update_dict)
+        server_update_message = messages.build_message(messages.SERVER_UPDATE_MESSAGE, server_update_dict)
     except construct.ConstructError as e:
         # Should never occur
         print(f"Failed to build server update message: {e.args}")
         return False
 
     # Sends server information update (should also update local server information)
-    updater.send_broadcast(server_update_message)
+    updater.send_announcement(server_update_message)
     print("Server information was sent to services!")
     return True
 
 
+def get_previous_update(version):
+    # Returns the file of the current update, which the new version is created from (None if there is none)
+    previous_version = updater.Version.get_current_version()
+    previous_registry = previous_version.get_update_registry_path()
+    if previous_version >= version or not registry.exists(previous_registry):
+        return None
+    return registry.get_value(previous_registry)
+
+
+def create_update_delta(update_path, version):
+    # Creates binary patches from the current update to the new version
+    previous_version = updater.Version.get_current_version()
+    previous_filepath = get_previous_update(version)
+    if previous_filepath is None:
+        return True
+
+    if not os.path.exists(previous_filepath):
+        print(f"Update file of version {previous_version} is missing, skipping delta creation.")
+        return True
+
+    delta_filepath = f"{settings.UPDATE_PATH}.{version}.delta"
+    try:
+        delta_manifest = delta.create_delta(previous_filepath, update_path, delta_filepath, previous_version, version)
+    except (PermissionError, zipfile.BadZipFile):
+        print(f"Failed to create delta file {delta_filepath} from version {previous_version}.")
+        return False
+
+    # Signs the chunks of the delta, so clients can verify it while downloading.
+    # The manifest keeps the signature of the delta and the hashes of the files it patches and adds.
+    delta_files = {member_name: entry["hash"] for section in ["patched", "added"]
+                   for member_name, entry in delta_manifest[section].items()}
+    manifest.Manifest.create(delta_filepath, version, delta_files).save(manifest.get_manifest_path(delta_filepath))
+
+    # Updating registry with delta info
+    with registry.batch():
+        registry.set_value(version.get_delta_registry_path(), os.path.abspath(delta_filepath))
+        registry.set_value(version.get_delta_base_registry_path(), str(previous_version))
+
+    print(f"Created delta from version {previous_version}: {len(delta_manifest['patched'])} patched, "
+          f"{len(delta_manifest['added'])} added and {len(delta_manifest['removed'])} removed files.")
+    return True
+
+
 def create_update(update_path, major, minor):
     version = updater.Version(major, minor)
 
+    # Creating the delta must happen before the new version becomes the current version
+    if not create_update_delta(update_path, version):
+        return False
+
+    # Unchanged files are copied from the previous update
+    previous_version = updater.Version.get_current_version()
+    previous_filepath = get_previous_update(version)
+    if previous_filepath is not None and not zipfile.is_zipfile(previous_filepath):
+        print(f"Update file of version {previous_version} is missing or invalid, compressing all the files.")
+        previous_filepath = None
+    previous_files = None
+    if previous_filepath is not None:
+        previous_files = get_previous_files(previous_filepath)
+        if previous_files is None:
+            print(f"Manifest of version {previous_version} has no hashes of the files, compressing all the files.")
+            previous_filepath = None
+
     try:
         update_filepath = settings.UPDATE_PATH
         update_filepath = f"{update_filepath}.{version}"
@@ -206,13 +316,20 @@ def create_update(update_path, major, minor):
     # Creating update zip
     with update_file:
         update_zip = zipfile.ZipFile(update_file, "w")
-        zip_directory(update_path, update_zip)
+        compressed_count, reused_count, file_hashes = zip_directory(update_path, update_zip, previous_filepath, previous_files)
         update_zip.close()
+    if previous_filepath is not None:
+        print(f"Compressed {compressed_count} files, copied {reused_count} unchanged files from version {previous_version}.")
+
+    # Signs the chunks of the update, so clients can verify it while downloading.
+    # The manifest keeps the signature of the update as well, so announcing it doesn't hash the update again.
+    manifest.Manifest.create(update_filepath, version, file_hashes).save(manifest.get_manifest_path(update_filepath))
 
     # Updating registry with update info
     version_registry = version.get_update_registry_path()
-    registry.set_value(version_registry, os.path.abspath(update_filepath))
-    version.update_current_version()
+    with registry.batch():
+        registry.set_value(version_registry, os.path.abspath(update_filepath))
+        version.update_current_version()
 
     print(f"Created update version {version} successfully!")
     return True
@@ -221,55 +338,22 @@ def create_update(update_path, major, minor):
 def broadcast_update_version(spread=True):
     # Gets the update info and update file
     update_version = updater.Version.get_current_version()
-    version_registry = update_version.get_update_registry_path()
-    update_filepath = registry.get_value(version_registry)
+    update_filepath = registry.get_value(update_version.get_update_registry_path())
 
-    # Tries to open update file (might fail if clients are downloading it)
+    # Calculates size and signature of update, and signs the message
     try:
-        file_size = os.stat(update_filepath).st_size
-        update_file = open(update_filepath, "rb")
+        version_update_message = updater.AnnouncementCache().get(update_version, spread)
+        print(f"Spread: {spread}")
     except PermissionError:
-        print(f"Failed to write update file {settings.UPDATE_PATH}. Insufficient permission or file is locked.")
+        print(f"Failed to read update file {update_filepath}. Insufficient permission or file is locked.")
         return False
-
-    # Calculates size and signature of update
-    data_received = 0
-    hash_object = settings.HASH_MODULE()
-
-    # Calculate update signature
-    with update_file:
-        while data_received < file_size:
-            chunk = update_file.read(settings.VERSION_CHUNK_SIZE)
-            hash_object.update(chunk)
-            data_received += len(chunk)
-    signature = rsa_signing.sign_hash(hash_object)
-
-    # Creates broadcast message
-    version_update_dict = dict(
-        type=MessageType.VERSION_UPDATE,
-        header_signature=0,
-        major=update_version.major,
-        minor=update_version.minor,
-        size=file_size,
-        update_signature=signature,
-        spread=spread
-    )
-
-    # Calculate signature of message
-    try:
-        version_update_message = messages.VERSION_UPDATE_MESSAGE.build(version_update_dict)
-
-        # Update signature
-        version_update_dict["header_signature"] = messages.sign_message(version_update_message)
-        print(f"Spread: {version_update_dict['spread']}")
-        version_update_message = messages.VERSION_UPDATE_MESSAGE.build(version_update_dict)
     except construct.ConstructError:
         # Should never occur
         print(f"Failed to build request update message")
         return False
 
     # Sends the message
-    updater.send_broadcast(version_update_message)
+    updater.send_announcement(version_update_message)
     # After the update is announced, the service will send it to the clients, when they ask for it
     print(f"Broadcast was sent with version {update_version} !")
     return True
@@ -357,8 +441,8 @@ def create_installer(program_name, major, minor, software_path, updater_path, la
         return False
     print("Created new settings file!\n")
 
-    # Generate RSA keys and add to settings/registry
-    generate_rsa_keys(display_keys=False)
+    # Generate keys and add to settings/registry
+    generate_keys(display_keys=False)
 
     # Create build directory
     if not os.path.isdir(BUILD_DIRECTORY):
@@ -430,6 +514,7 @@ def main():
 
     # Top level commands
     rsa_group = subparsers.add_parser("rsa")
+    ed25519_group = subparsers.add_parser("ed25519")
     update_group = subparsers.add_parser("update")
     server_group = subparsers.add_parser("server")
     setup_group = subparsers.add_parser("setup")
@@ -444,6 +529,16 @@ def main():
     rsa_show = subparsers.add_parser("show")
     rsa_show.set_defaults(func=show_rsa_keys)
 
+    # Sub-commands of ed25519
+
+    subparsers = ed25519_group.add_subparsers()
+    # generate
+    ed25519_generate = subparsers.add_parser("generate")
+    ed25519_generate.set_defaults(func=generate_ed25519_keys)
+    # show
+    ed25519_show = subparsers.add_parser("show")
+    ed25519_show.set_defaults(func=show_ed25519_keys)
+
     # Sub-commands of update
 
     subparsers = update_group.add_subparsers()
@@ -0,0 +1,104 @@
+import os
+import json
+import zipfile
+
+import bsdiff4
+
+from Updater import settings
+
+DELTA_MANIFEST_NAME = "delta.json"
+PATCHES_FOLDER = "patches"
+FILES_FOLDER = "files"
+
+
+def get_member_name(relative_path):
+    # Zip members always use '/' as a separator
+    return relative_path.replace(os.path.sep, "/")
+
+
+def is_delta(zip_handler):
+    return DELTA_MANIFEST_NAME in zip_handler.namelist()
+
+
+def read_manifest(zip_handler):
+    return json.loads(zip_handler.read(DELTA_MANIFEST_NAME).decode("utf-8"))
+
+
+def create_delta(previous_update_path, update_path, delta_path, base_version, version):
+    manifest = dict(
+        base=str(base_version),
+        version=str(version),
+        patched=dict(),
+        added=dict(),
+        removed=list(),
+    )
+
+    with zipfile.ZipFile(previous_update_path, "r") as previous_zip, zipfile.ZipFile(delta_path, "w") as delta_zip:
+        previous_members = set(info.filename for info in previous_zip.infolist() if not info.is_dir())
+        current_members = set()
+
+        for root, dirs, files in os.walk(update_path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                member_name = get_member_name(os.path.relpath(file_path, update_path))
+                current_members.add(member_name)
+
+                with open(file_path, "rb") as current_file:
+                    current_data = current_file.read()
+                file_hash = settings.HASH_MODULE(current_data).hexdigest()
+
+                if member_name not in previous_members:
+                    # A new file, there is nothing to patch against
+                    delta_member = f"{FILES_FOLDER}/{member_name}"
+                    delta_zip.writestr(delta_member, current_data)
+                    manifest["added"][member_name] = dict(member=delta_member, hash=file_hash)
+                    continue
+
+                previous_data = previous_zip.read(member_name)
+                if previous_data == current_data:
+                    # Unchanged file, nothing to do
+                    continue
+
+                delta_member = f"{PATCHES_FOLDER}/{member_name}"
+                delta_zip.writestr(delta_member, bsdiff4.diff(previous_data, current_data))
+                manifest["patched"][member_name] = dict(member=delta_member, hash=file_hash)
+
+        manifest["removed"] = sorted(previous_members - current_members)
+        delta_zip.writestr(DELTA_MANIFEST_NAME, json.dumps(manifest))
+
+    return manifest
+
+
+def apply_member(zip_handler, manifest, member_name, program_path):
+    # Applies a single entry of the delta manifest to the installed program.
+    # Returns False if the result does not match the hash the server calculated.
+    file_path = os.path.join(program_path, *member_name.split("/"))
+
+    if member_name in manifest["removed"]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        return True
+
+    if member_name in manifest["patched"]:
+        entry = manifest["patched"][member_name]
+        with open(file_path, "rb") as installed_file:
+            data = bsdiff4.patch(installed_file.read(), zip_handler.read(entry["member"]))
+    else:
+        entry = manifest["added"][member_name]
+        data = zip_handler.read(entry["member"])
+
+    if settings.HASH_MODULE(data).hexdigest() != entry["hash"]:
+        # The installed file is not the one the patch was created against
+        return False
+
+    # Writes next to the original file, so a failure never leaves a half written file behind
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = f"{file_path}.patching"
+    with open(temp_path, "wb") as patched_file:
+        patched_file.write(data)
+    os.replace(temp_path, file_path)
+    return True
+
+
+def get_members(manifest):
+    return list(manifest["patched"]) + list(manifest["added"]) + list(manifest["removed"])
@@ -0,0 +1,47 @@
+import time
+import collections
+
+from Updater import settings
+
+
+class DuplicateFilter(object):
+    # Remembers the digests of recently seen messages (least recently seen are forgotten first),
+    # so copies of a message that were spread by other peers or received on another interface are dropped early.
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.seen = collections.OrderedDict()  # Expiration time, by message digest
+
+    @staticmethod
+    def get_digest(message):
+        return settings.HASH_MODULE(message).digest()
+
+    def is_seen(self, digest, now):
+        expiration = self.seen.get(digest)
+        if expiration is not None and expiration > now:
+            self.seen.move_to_end(digest)
+            return True
+        return False
+
+    def contains(self, message):
+        # Returns True if the message was seen recently, without remembering it
+        return self.is_seen(DuplicateFilter.get_digest(message), time.monotonic())
+
+    def check(self, message):
+        # Returns True if the message was already seen, otherwise remembers it
+        digest = DuplicateFilter.get_digest(message)
+        now = time.monotonic()
+        if self.is_seen(digest, now):
+            return True
+
+        self.seen[digest] = now + self.ttl
+        self.seen.move_to_end(digest)
+        while len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        return False
+
+    def remember(self, message):
+        self.check(message)
+
+    def forget(self, message):
+        self.seen.pop(DuplicateFilter.get_digest(message), None)
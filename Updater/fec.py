@@ -0,0 +1,157 @@
+import logging
+import struct
+
+from Updater import settings
+
+# Every packet of a multicast transfer starts with: major, minor, content, chunk index, block index
+# (the group index for parity blocks) and whether it is a parity block.
+# A plain struct is used since the header is parsed for every block of the update.
+PACKET_HEADER = struct.Struct(">HHBIHB")
+
+
+def get_blocks_count(length):
+    return (length + settings.FEC_BLOCK_SIZE - 1) // settings.FEC_BLOCK_SIZE
+
+
+def get_groups_count(blocks_count):
+    return (blocks_count + settings.FEC_GROUP_SIZE - 1) // settings.FEC_GROUP_SIZE
+
+
+def get_group_blocks(group, blocks_count):
+    # Groups are interleaved (block j belongs to group j % groups count), so a burst of lost packets
+    # hits every group at most once
+    return range(group, blocks_count, get_groups_count(blocks_count))
+
+
+def get_block_range(block, length):
+    offset = block * settings.FEC_BLOCK_SIZE
+    return offset, min(settings.FEC_BLOCK_SIZE, length - offset)
+
+
+def xor_blocks(blocks):
+    # Short blocks (the last one of a chunk) are padded with zeros
+    value = 0
+    for block in blocks:
+        value ^= int.from_bytes(block.ljust(settings.FEC_BLOCK_SIZE, b"\0"), byteorder='big')
+    return value.to_bytes(settings.FEC_BLOCK_SIZE, byteorder='big')
+
+
+def get_chunk_packets(major, minor, content, index, data):
+    # Splits a chunk into blocks, followed by one parity block (the xor of its blocks) for every group
+    blocks_count = get_blocks_count(len(data))
+    blocks = [data[offset:offset + settings.FEC_BLOCK_SIZE]
+              for offset in range(0, len(data), settings.FEC_BLOCK_SIZE)]
+
+    packets = [PACKET_HEADER.pack(major, minor, content, index, block, False) + blocks[block]
+               for block in range(blocks_count)]
+    for group in range(get_groups_count(blocks_count)):
+        parity = xor_blocks(blocks[block] for block in get_group_blocks(group, blocks_count))
+        packets.append(PACKET_HEADER.pack(major, minor, content, index, group, True) + parity)
+    return packets
+
+
+class TransferDecoder(object):
+    # Rebuilds the chunks of an update from the packets of a multicast transfer.
+    # The blocks of the chunk being streamed are kept in memory, a single lost block of a group is recovered
+    # from the parity block of the group, and a chunk is written once it was verified with the manifest.
+    # Blocks of chunks that could not be completed are written as well, so the next pass only needs the rest.
+    def __init__(self, version, content, update_manifest, update_file, missing_chunks):
+        self.version = version
+        self.content = int(content)
+        self.update_manifest = update_manifest
+        self.update_file = update_file
+        self.missing_chunks = missing_chunks
+        self.received_blocks = dict()  # Blocks that were written to the update file, by (incomplete) chunk
+        self.index = None  # The chunk being received
+        self.data = None
+        self.blocks = None
+        self.parities = None  # by group
+
+    def receive(self, packet):
+        # Returns the chunks that were completed and verified
+        if len(packet) <= PACKET_HEADER.size:
+            return []
+
+        major, minor, content, index, block, is_parity = PACKET_HEADER.unpack_from(packet)
+        if major != self.version.major or minor != self.version.minor or content != self.content:
+            # A transfer of another version
+            return []
+        if index not in self.missing_chunks:
+            return []
+
+        completed = []
+        if index != self.index:
+            # The stream moved on (or a packet was reordered), the previous chunk won't get more blocks
+            completed += self.finish()
+            self.start(index)
+
+        blocks_count = get_blocks_count(len(self.data))
+        payload = packet[PACKET_HEADER.size:]
+        if is_parity:
+            if block < get_groups_count(blocks_count) and len(payload) == settings.FEC_BLOCK_SIZE:
+                self.parities[block] = payload
+            if block == get_groups_count(blocks_count) - 1:
+                # The last parity block ends the chunk
+                completed += self.finish()
+        elif block < blocks_count:
+            offset, length = get_block_range(block, len(self.data))
+            if len(payload) == length:
+                self.data[offset:offset + length] = payload
+                self.blocks.add(block)
+            if len(self.blocks) == blocks_count:
+                completed += self.finish()
+
+        return completed
+
+    def start(self, index):
+        offset, length = self.update_manifest.get_chunk_range(index)
+        self.index = index
+        self.blocks = self.received_blocks.pop(index, set())
+        if len(self.blocks) != 0:
+            # Continues from the blocks that were received in a previous pass
+            self.update_file.seek(offset)
+            self.data = bytearray(self.update_file.read(length))
+        else:
+            self.data = bytearray(length)
+        self.parities = dict()
+
+    def finish(self):
+        if self.index is None:
+            return []
+
+        index, data, blocks, parities = self.index, self.data, self.blocks, self.parities
+        self.index = self.data = self.blocks = self.parities = None
+
+        blocks_count = get_blocks_count(len(data))
+        for group, parity in parities.items():
+            group_blocks = get_group_blocks(group, blocks_count)
+            lost_blocks = [block for block in group_blocks if block not in blocks]
+            if len(lost_blocks) != 1:
+                # Nothing to recover, or too many blocks were lost
+                continue
+
+            lost_offset, lost_length = get_block_range(lost_blocks[0], len(data))
+            other_blocks = [bytes(data[offset:offset + length])
+                            for offset, length in (get_block_range(block, len(data)) for block in group_blocks)
+                            if offset != lost_offset]
+            data[lost_offset:lost_offset + lost_length] = xor_blocks([parity] + other_blocks)[:lost_length]
+            blocks.add(lost_blocks[0])
+
+        if len(blocks) == blocks_count:
+            if not self.update_manifest.is_valid_chunk(index, data):
+                # Drop the whole chunk, every block is received again
+                logging.info(f"Chunk {index} of version {self.version} from the multicast transfer is corrupted")
+                return []
+        elif len(blocks) == 0:
+            return []
+        else:
+            self.received_blocks[index] = blocks
+
+        offset, _ = self.update_manifest.get_chunk_range(index)
+        self.update_file.seek(offset)
+        self.update_file.write(data)
+
+        if len(blocks) != blocks_count:
+            return []
+        self.missing_chunks.discard(index)
+        return [index]
@@ -0,0 +1,126 @@
+import random
+import argparse
+import collections
+
+from Updater import settings
+
+
+class PeerList(object):
+    # The peers a node knows (configured seeds, the peers it exchanged peers with and the peers those sent, the senders
+    # of signed announcements and the peers that served verified parts of an update), used to forward announcements to
+    # a random few of them instead of broadcasting them to whole subnets.
+    # The least recently heard peers are forgotten first, seeds are never forgotten.
+    def __init__(self, seeds, max_peers, generator=random):
+        self.seeds = list(seeds)
+        self.max_peers = max_peers
+        self.generator = generator
+        self.peers = collections.OrderedDict()
+
+    def add(self, peer):
+        if peer in self.seeds:
+            return
+
+        self.peers[peer] = True
+        self.peers.move_to_end(peer)
+        while len(self.peers) > self.max_peers:
+            self.peers.popitem(last=False)
+
+    def sample(self, count, exclude=()):
+        candidates = [peer for peer in self.seeds + list(self.peers) if peer not in exclude]
+        return self.generator.sample(candidates, min(count, len(candidates)))
+
+    def get_exchange(self, count, target):
+        # The peers that are sent to the target of an exchange (a node registers with the seeds the same way)
+        return self.sample(count, exclude=[target])
+
+    def merge_exchange(self, sender, peers, exclude=()):
+        # Remembers the sender of an exchange and the peers it sent, except for excluded ones (the node itself)
+        self.add(sender)
+        for peer in peers:
+            if peer != sender and peer not in exclude:
+                self.add(peer)
+
+
+def exchange(views, node, target, exchange_size):
+    # A node sends some of its peers to the target, which answers with some of its own
+    sent = views[node].get_exchange(exchange_size, target)
+    answer = views[target].get_exchange(exchange_size, node)
+    views[target].merge_exchange(node, sent, exclude=[target])
+    views[node].merge_exchange(target, answer, exclude=[node])
+
+
+def build_views(nodes, seeds, max_peers, exchange_size, exchange_rounds, generator):
+    # Builds the peer lists the membership protocol produces: nodes 0..seeds-1 are the seeds, every node registers with
+    # all the seeds when it starts (in a random order), and then exchanges peers with a random known peer once a round
+    views = [PeerList([seed for seed in range(seeds) if seed != node], max_peers, generator) for node in range(nodes)]
+    joining = list(range(nodes))
+    generator.shuffle(joining)
+    for node in joining:
+        for seed in views[node].seeds:
+            exchange(views, node, seed, exchange_size)
+
+    for _ in range(exchange_rounds):
+        for node in range(nodes):
+            targets = views[node].sample(1)
+            if len(targets) != 0:
+                exchange(views, node, targets[0], exchange_size)
+    return views
+
+
+def simulate(nodes, fanout, max_peers, seeds, exchange_size, exchange_rounds, seed=None):
+    # Simulates the spread of a single announcement with push gossip, over the views the membership protocol built.
+    # The update server (the last node) sends the announcement to all the seeds, and every node forwards it once,
+    # to `fanout` random peers of its view (never back to its sender), when it receives it for the first time.
+    # Returns the number of rounds until no node forwards anymore, the number of covered nodes and
+    # the number of messages sent.
+    generator = random.Random(seed)
+    views = build_views(nodes, seeds, max_peers, exchange_size, exchange_rounds, generator)
+
+    server = nodes - 1
+    covered = {server}
+    forwarding = []
+    messages_sent = 0
+    for seed_node in range(seeds):
+        messages_sent += 1
+        if seed_node not in covered:
+            covered.add(seed_node)
+            forwarding.append((seed_node, server))
+
+    rounds = 0
+    while len(forwarding) != 0:
+        rounds += 1
+        received = []
+        for node, sender in forwarding:
+            for peer in views[node].sample(fanout, exclude=[sender]):
+                messages_sent += 1
+                if peer not in covered:
+                    covered.add(peer)
+                    received.append((peer, node))
+        forwarding = received
+
+    return rounds, len(covered), messages_sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates gossip propagation of an announcement")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--fanout", type=int, default=settings.GOSSIP_FANOUT)
+    parser.add_argument("--view", type=int, default=settings.GOSSIP_MAX_PEERS,
+                        help="The number of peers every node remembers (besides the seeds)")
+    parser.add_argument("--seeds", type=int, default=max(len(settings.GOSSIP_PEERS), 1))
+    parser.add_argument("--exchange", type=int, default=settings.GOSSIP_EXCHANGE_SIZE,
+                        help="The number of peers sent in a single exchange")
+    parser.add_argument("--exchanges", type=int, default=5,
+                        help="The number of exchanges every node made since it registered with the seeds")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for run in range(args.runs):
+        rounds, covered, messages_sent = simulate(args.nodes, args.fanout, args.view, args.seeds, args.exchange,
+                                                  args.exchanges, seed=run)
+        print(f"Run {run}: {rounds} rounds, covered {covered}/{args.nodes} nodes, {messages_sent} messages "
+              f"({messages_sent / args.nodes:.2f} per node)")
+
+
+if __name__ == "__main__":
+    main()
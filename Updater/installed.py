@@ -0,0 +1,67 @@
+import os
+import json
+
+
+def get_file_path(program_path, member_name):
+    # Zip members always use '/' as a separator
+    return os.path.join(program_path, *member_name.split("/"))
+
+
+class InstalledManifest(object):
+    # Records the files the launcher installed into the program folder: the crc32 and size of their zip member,
+    # and the size and modification time of the installed file, so a file that was changed since is never skipped.
+    def __init__(self, manifest_path, files=None):
+        self.manifest_path = manifest_path
+        self.files = files if files is not None else dict()  # [crc32, size, installed mtime], by member name
+
+    @staticmethod
+    def load(manifest_path):
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                return InstalledManifest(manifest_path, json.loads(manifest_file.read())["files"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # Without a manifest every file is installed again
+            return InstalledManifest(manifest_path)
+
+    def save(self):
+        # Replaces the manifest at once, so a crash never leaves a half written manifest
+        temp_path = f"{self.manifest_path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            manifest_file.write(json.dumps(dict(files=self.files)))
+        os.replace(temp_path, self.manifest_path)
+
+    def is_installed(self, member, program_path):
+        # Returns True if the installed file is the member of the zip
+        file_path = get_file_path(program_path, member.filename)
+        if member.is_dir():
+            return os.path.isdir(file_path)
+
+        entry = self.files.get(member.filename)
+        if entry is None or entry[0] != member.CRC or entry[1] != member.file_size:
+            return False
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return False
+        return file_stat.st_size == member.file_size and file_stat.st_mtime_ns == entry[2]
+
+    def record(self, member, file_path):
+        if not member.is_dir():
+            self.files[member.filename] = [member.CRC, member.file_size, os.stat(file_path).st_mtime_ns]
+
+    def forget(self, member_name):
+        self.files.pop(member_name, None)
+
+    def get_changed_members(self, members, program_path):
+        return [member for member in members if not self.is_installed(member, program_path)]
+
+    def remove_dropped_files(self, members, program_path):
+        # Deletes the installed files that are not part of the release anymore.
+        # Only files the launcher installed are deleted, never files that were created by the program.
+        member_names = set(member.filename for member in members)
+        for member_name in [member_name for member_name in self.files if member_name not in member_names]:
+            try:
+                os.remove(get_file_path(program_path, member_name))
+            except FileNotFoundError:
+                pass
+            self.forget(member_name)
@@ -0,0 +1,169 @@
+import time
+import socket
+import logging
+import ipaddress
+import threading
+
+import netifaces
+
+from Updater import settings
+
+try:
+    import ctypes
+    import ctypes.wintypes
+    import win32event
+    iphlpapi = ctypes.windll.iphlpapi
+except (ImportError, AttributeError, OSError):
+    # Not on Windows (or without pywin32), the table is only refreshed when it expires
+    iphlpapi = None
+
+ERROR_IO_PENDING = 997
+
+
+class InterfaceSnapshot(object):
+    # The addresses and networks of the interfaces at a single moment, computed once for all the messages
+    # that are sent until the next change
+    def __init__(self):
+        self.addresses = []  # IPv4 addresses of the interfaces, except for loop-back
+        self.networks = []  # IPv4 networks of the interfaces (that have a netmask), except for loop-back
+        for interface in netifaces.interfaces():
+            for address in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+                if "addr" not in address or ipaddress.ip_address(address["addr"]).is_loopback:
+                    continue
+                self.addresses.append(address["addr"])
+
+                if "netmask" in address:
+                    self.networks.append(ipaddress.ip_interface(address["addr"] + "/" + address["netmask"]).network)
+
+        self.broadcasts = [network.broadcast_address.compressed for network in self.networks]
+        self.ipv6_indices = [index for index, name in socket.if_nameindex()]
+        self.sender_broadcasts = dict()  # Broadcast addresses that exclude the network of the sender, by sender
+
+    def get_broadcast_addresses(self, sender=None):
+        if not sender:
+            return self.broadcasts
+
+        broadcasts = self.sender_broadcasts.get(sender)
+        if broadcasts is None:
+            # We skip the networks of the sender, since our sender already sent a broadcast to them
+            sender_address = ipaddress.ip_address(sender)
+            broadcasts = [broadcast for network, broadcast in zip(self.networks, self.broadcasts)
+                          if sender_address not in network]
+            self.sender_broadcasts[sender] = broadcasts
+        return broadcasts
+
+
+class InterfaceTable(object):
+    # Keeps a snapshot of the interfaces, which is taken again when it expires (after INTERFACES_TTL seconds)
+    # or when an address of an interface changes (while the table is watched)
+    def __init__(self):
+        self.snapshot = None
+        self.expiration = 0
+        self.watcher = None
+        self.lock = threading.Lock()
+
+    def get_snapshot(self):
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() < self.expiration:
+            return snapshot
+
+        with self.lock:
+            if self.snapshot is None or time.monotonic() >= self.expiration:
+                # The expiration is set before the snapshot is taken, so a change made meanwhile invalidates it
+                self.expiration = time.monotonic() + settings.INTERFACES_TTL
+                self.snapshot = InterfaceSnapshot()
+            return self.snapshot
+
+    def invalidate(self):
+        self.expiration = 0
+
+    def watch(self):
+        # Returns False if the addresses can't be watched
+        with self.lock:
+            if self.watcher is None and iphlpapi is not None:
+                try:
+                    self.watcher = AddressChangeWatcher(self.invalidate)
+                    self.watcher.start()
+                except OSError:
+                    logging.warning("Failed to watch the addresses of the interfaces", exc_info=True)
+                    self.watcher = None
+                self.expiration = 0
+            return self.watcher is not None
+
+    def unwatch(self):
+        with self.lock:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+
+
+if iphlpapi is not None:
+    class OVERLAPPED(ctypes.Structure):
+        _fields_ = [("Internal", ctypes.c_void_p),
+                    ("InternalHigh", ctypes.c_void_p),
+                    ("Offset", ctypes.wintypes.DWORD),
+                    ("OffsetHigh", ctypes.wintypes.DWORD),
+                    ("hEvent", ctypes.wintypes.HANDLE)]
+
+
+class AddressChangeWatcher(threading.Thread):
+    # Calls on_change whenever an IPv4 address is added to or removed from an interface
+    def __init__(self, on_change):
+        super().__init__(daemon=True)
+        self.on_change = on_change
+        self.changed_event = win32event.CreateEvent(None, False, False, None)
+        self.stop_event = win32event.CreateEvent(None, True, False, None)
+        self.overlapped = OVERLAPPED(hEvent=int(self.changed_event))
+
+        # Armed before the table is used, so no change is missed
+        self.arm()
+
+    def arm(self):
+        handle = ctypes.wintypes.HANDLE()
+        result = iphlpapi.NotifyAddrChange(ctypes.byref(handle), ctypes.byref(self.overlapped))
+        if result != ERROR_IO_PENDING:
+            raise OSError(result, "NotifyAddrChange failed")
+
+    def run(self):
+        while True:
+            result = win32event.WaitForMultipleObjects([self.changed_event, self.stop_event], False,
+                                                       win32event.INFINITE)
+            if result != win32event.WAIT_OBJECT_0:
+                break
+
+            # Armed again before invalidating, so a change made meanwhile invalidates the table once more
+            try:
+                self.arm()
+            except OSError:
+                logging.warning("Failed to watch the addresses of the interfaces", exc_info=True)
+                self.on_change()
+                return
+            self.on_change()
+
+        iphlpapi.CancelIPChangeNotify(ctypes.byref(self.overlapped))
+
+    def stop(self):
+        win32event.SetEvent(self.stop_event)
+
+
+table = InterfaceTable()
+
+
+def watch():
+    return table.watch()
+
+
+def unwatch():
+    table.unwatch()
+
+
+def get_broadcast_addresses(sender=None):
+    return table.get_snapshot().get_broadcast_addresses(sender)
+
+
+def get_addresses():
+    return table.get_snapshot().addresses
+
+
+def get_ipv6_indices():
+    return table.get_snapshot().ipv6_indices
@@ -0,0 +1,82 @@
+import os
+import glob
+import json
+
+from Updater import settings
+
+
+def get_journal_path(update_path):
+    return f"{update_path}.journal"
+
+
+def get_update_path(journal_path):
+    return journal_path[:-len(".journal")]
+
+
+def get_all_journals():
+    return glob.glob(get_journal_path(f"{glob.escape(settings.UPDATE_PATH)}.*"))
+
+
+class DownloadJournal(object):
+    # Records the progress of a partial download, so it can be resumed after a timeout or a restart of the service
+    def __init__(self, journal_path, version, content, size, signature, chunks_count, announcement, peer, bitmap=None):
+        self.journal_path = journal_path
+        self.version = str(version)
+        self.content = int(content)
+        self.size = size
+        self.signature = signature
+        self.chunks_count = chunks_count
+        self.announcement = announcement  # The signed VERSION_UPDATE message the download was started by
+        self.peer = peer
+        self.bitmap = bitmap if bitmap is not None else bytearray((chunks_count + 7) // 8)
+
+    @staticmethod
+    def load(journal_path):
+        try:
+            with open(journal_path, "r") as journal_file:
+                values = json.loads(journal_file.read())
+
+            return DownloadJournal(journal_path, values["version"], values["content"], values["size"],
+                                   int(values["signature"], 16), values["chunks_count"],
+                                   bytes.fromhex(values["announcement"]), values["peer"],
+                                   bytearray.fromhex(values["bitmap"]))
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            # A corrupted journal is as good as no journal
+            return None
+
+    def save(self):
+        values = dict(
+            version=self.version,
+            content=self.content,
+            size=self.size,
+            signature=hex(self.signature),
+            chunks_count=self.chunks_count,
+            announcement=self.announcement.hex(),
+            peer=self.peer,
+            bitmap=self.bitmap.hex(),
+        )
+
+        # Replaces the journal at once, so a crash never leaves a half written journal
+        temp_path = f"{self.journal_path}.tmp"
+        with open(temp_path, "w") as journal_file:
+            journal_file.write(json.dumps(values))
+        os.replace(temp_path, self.journal_path)
+
+    def delete(self):
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+
+    def matches(self, version, content, size, signature, chunks_count):
+        return (self.version == str(version) and self.content == int(content) and self.size == size and
+                self.signature == signature and self.chunks_count == chunks_count)
+
+    def mark_completed(self, chunks):
+        for index in chunks:
+            self.bitmap[index // 8] |= 1 << (index % 8)
+
+    def get_completed(self):
+        return set(index for index in range(self.chunks_count) if self.bitmap[index // 8] & (1 << (index % 8)))
@@ -0,0 +1,160 @@
+import os
+import json
+
+from Updater import settings
+from Updater import signing
+
+
+def get_manifest_path(update_path):
+    return f"{update_path}.manifest"
+
+
+def hash_chunk(data):
+    return settings.HASH_MODULE(data).digest()
+
+
+def calculate_root(chunk_hashes):
+    # Calculates the root of a Merkle tree built over the chunk hashes.
+    # An odd node at the end of a level is paired with itself.
+    level = list(chunk_hashes)
+    if len(level) == 0:
+        return hash_chunk(b"")
+
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        level = [hash_chunk(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class Digest(object):
+    # A hash that was calculated before, in place of a hash object (signing only needs its digest)
+    def __init__(self, digest):
+        self.value = digest
+
+    def digest(self):
+        return self.value
+
+
+class Manifest(object):
+    # Describes an update: the hashes of its chunks (signed through their Merkle root), the hash of the whole update
+    # and its signature (the one VERSION_UPDATE carries) and the hashes of the files in it, by member name.
+    # Manifests created before the update hash was kept have neither the update hash nor the files.
+    def __init__(self, version, size, chunk_size, chunks, signature=0, update_hash=None, update_signature=None,
+                 files=None):
+        self.version = version
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = chunks
+        self.signature = signature
+        self.update_hash = update_hash
+        self.update_signature = update_signature
+        self.files = files if files is not None else dict()
+
+    @staticmethod
+    def create(update_path, version, files=None):
+        # The chunks and the whole update are hashed in a single pass
+        chunk_size = settings.MANIFEST_CHUNK_SIZE
+        chunks = []
+        update_hash = settings.HASH_MODULE()
+        with open(update_path, "rb") as update_file:
+            chunk = update_file.read(chunk_size)
+            while len(chunk) != 0:
+                chunks.append(hash_chunk(chunk))
+                update_hash.update(chunk)
+                chunk = update_file.read(chunk_size)
+
+        manifest = Manifest(str(version), os.stat(update_path).st_size, chunk_size, chunks,
+                            update_hash=update_hash.digest(), files=files)
+        manifest.signature = signing.sign(manifest.get_signed_data())
+        manifest.update_signature = signing.sign_hash(update_hash)
+        return manifest
+
+    @staticmethod
+    def loads(data):
+        values = json.loads(data)
+        chunks = [bytes.fromhex(chunk) for chunk in values["chunks"]]
+        update_hash = bytes.fromhex(values["update_hash"]) if "update_hash" in values else None
+        update_signature = int(values["update_signature"], 16) if "update_signature" in values else None
+        return Manifest(values["version"], values["size"], values["chunk_size"], chunks, int(values["signature"], 16),
+                        update_hash, update_signature, values.get("files"))
+
+    @staticmethod
+    def load(manifest_path):
+        with open(manifest_path, "rb") as manifest_file:
+            return Manifest.loads(manifest_file.read())
+
+    def dumps(self):
+        values = dict(
+            version=self.version,
+            size=self.size,
+            chunk_size=self.chunk_size,
+            chunks=[chunk.hex() for chunk in self.chunks],
+            signature=hex(self.signature),
+        )
+        if self.update_hash is not None:
+            values.update(
+                update_hash=self.update_hash.hex(),
+                update_signature=hex(self.update_signature),
+                files=self.files,
+            )
+        return json.dumps(values, sort_keys=True).encode("ascii")
+
+    def save(self, manifest_path):
+        # Replaces the manifest at once, so a crash never leaves a half written manifest
+        temp_path = f"{manifest_path}.tmp"
+        with open(temp_path, "wb") as manifest_file:
+            manifest_file.write(self.dumps())
+        os.replace(temp_path, manifest_path)
+
+    def get_signed_data(self):
+        # The version and size are signed with the root, so a manifest can't be replayed for another update.
+        # The update hash and the files are signed as well (when the manifest has them), so they can't be stripped.
+        data = f"{self.version}:{self.size}:".encode("ascii") + calculate_root(self.chunks)
+        if self.update_hash is not None:
+            data += self.update_hash + hash_chunk(json.dumps(self.files, sort_keys=True).encode("utf-8"))
+        return data
+
+    def is_valid(self, version, size):
+        if self.version != str(version) or self.size != size or self.chunk_size <= 0:
+            return False
+        if len(self.chunks) != self.get_chunks_count(size, self.chunk_size):
+            return False
+        return signing.validate(self.get_signed_data(), self.signature)
+
+    @staticmethod
+    def get_chunks_count(size, chunk_size):
+        return (size + chunk_size - 1) // chunk_size
+
+    def get_chunk_range(self, index):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def is_valid_chunk(self, index, data):
+        return hash_chunk(data) == self.chunks[index]
+
+    def get_update_hash(self):
+        # The hash of the whole update, or None if the manifest doesn't have it.
+        # Once every chunk was verified, the update is known to have this hash without hashing it again.
+        if self.update_hash is None:
+            return None
+        return Digest(self.update_hash)
+
+    def get_update_signature(self):
+        # The signature of the whole update, or None if the manifest doesn't have a valid one
+        if self.update_hash is None or self.update_signature is None:
+            return None
+        if not signing.validate_hash(self.get_update_hash(), self.update_signature):
+            # Signed with other keys
+            return None
+        return self.update_signature
+
+    @staticmethod
+    def get_max_size(size):
+        # Upper bound of a serialized manifest of an update with the given size (used to limit downloads).
+        # The hashes of the files take a small share of the update (every file costs at least its headers in the zip),
+        # up to a fixed cap, so a peer can't make a client buffer a huge manifest of a large update.
+        chunks_count = Manifest.get_chunks_count(size, settings.MANIFEST_CHUNK_SIZE)
+        files_size = min(size // settings.MANIFEST_FILES_SHARE, settings.MANIFEST_FILES_MAX_SIZE)
+        return chunks_count * (settings.HASH_MODULE().digest_size * 2 + 4) + settings.SIGNATURE_SIZE * 4 + \
+            files_size + 64 * 1024
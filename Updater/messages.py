@@ -1,10 +1,11 @@
 
 import construct
 import enum
+import struct
 import zlib
 
 from Updater import settings
-from Updater import rsa_signing
+from Updater import signing
 
 
 class MessageType(enum.IntEnum):
@@ -12,61 +13,207 @@ class MessageType(enum.IntEnum):
     SERVER_UPDATE = 2    # Announces a new server information - Can be sent by official update server only!
     REQUEST_VERSION = 3  # Request specific version from a client / server
     REQUEST_UPDATE = 4   # Request the most updated version from a client / server
+    BUSY = 5             # A client / server can't serve a requested version right now
+    NOT_FOUND = 6        # A client / server doesn't have a requested version (or its manifest)
+    PEERS = 7            # Exchanges known peers with a client / server (gossip membership)
 
 
-GENERIC_MESSAGE =           construct.FixedSized(settings.MESSAGE_SIZE,
-                                construct.Struct(
-                                    "type"      / construct.Enum(construct.Byte, MessageType),
-                                    "signature" / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                    "data"      / construct.Bytes(settings.MESSAGE_SIZE - settings.SIGNATURE_SIZE - construct.Byte.sizeof())
-                                ))
-
-VERSION_UPDATE_MESSAGE =    construct.FixedSized(settings.MESSAGE_SIZE,
-                                construct.Struct(
-                                    "type"              / construct.Const(MessageType.VERSION_UPDATE.value, construct.Byte),
-                                    "header_signature"  / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                    "major"             / construct.Int16ub,
-                                    "minor"             / construct.Int16ub,
-                                    "size"              / construct.Int32ub,
-                                    "update_signature"  / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                    "spread"            / construct.Flag
-                                ))
-
-SERVER_UPDATE_MESSAGE =     construct.FixedSized(settings.MESSAGE_SIZE,
-                                construct.Struct(
-                                    "type"          / construct.Const(MessageType.SERVER_UPDATE.value, construct.Byte),
-                                    "signature"     / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                    "address_id"    / construct.Int16ub,    # A running count of the message.
-                                                                            # Higher id count means more updated information.
-                                                                            # prevents attackers from remotely
-                                                                            # 'updating' to old addresses
-                                    "address_size"  / construct.Int8ub,
-                                    "address"       / construct.Bytes(lambda ctx: ctx.address_size),   # could be a domain or IP
-                                    "port"          / construct.Int16ub,
-                                    "spread"        / construct.Flag
-                                ))
-
-REQUEST_VERSION_MESSAGE =    construct.FixedSized(settings.MESSAGE_SIZE,
-                                construct.Struct(
-                                    "type"              / construct.Const(MessageType.REQUEST_VERSION.value, construct.Byte),
-                                    "crc32"             / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                    "listening_port"    / construct.Int16ub,
-                                    "major"             / construct.Int16ub,
-                                    "minor"             / construct.Int16ub,
-                                ))
-
-REQUEST_UPDATE_MESSAGE =    construct.FixedSized(settings.MESSAGE_SIZE,
-                                construct.Struct(
-                                    "type"              / construct.Const(MessageType.REQUEST_UPDATE.value, construct.Byte),
-                                    "crc32"             / construct.BytesInteger(settings.SIGNATURE_SIZE),
-                                ))
+class VersionContent(enum.IntEnum):
+    UPDATE = 0  # The full update archive
+    DELTA = 1   # Binary patches from the previous version to the requested version
+
+
+def compile_formats(scheme, signature_size, message_size):
+    # Formats are compiled, so parsing and building run generated code instead of walking the construct tree
+    GENERIC_MESSAGE =           construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"      / construct.Enum(construct.Byte, MessageType),
+                                        "scheme"    / construct.Byte,
+                                        "signature" / construct.BytesInteger(signature_size),
+                                        "data"      / construct.Bytes(message_size - signature_size - construct.Byte.sizeof() * 2)
+                                    )).compile()
+
+    VERSION_UPDATE_MESSAGE =    construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.VERSION_UPDATE.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "header_signature"  / construct.BytesInteger(signature_size),
+                                        "major"             / construct.Int16ub,
+                                        "minor"             / construct.Int16ub,
+                                        "size"              / construct.Int32ub,
+                                        "update_signature"  / construct.BytesInteger(signature_size),
+                                        "delta_major"       / construct.Int16ub,    # The version the delta patches.
+                                        "delta_minor"       / construct.Int16ub,
+                                        "delta_size"        / construct.Int32ub,    # 0 means no delta is available
+                                        "delta_signature"   / construct.BytesInteger(signature_size),
+                                        "spread"            / construct.Flag
+                                    )).compile()
+
+    SERVER_UPDATE_MESSAGE =     construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"          / construct.Const(MessageType.SERVER_UPDATE.value, construct.Byte),
+                                        "scheme"        / construct.Const(scheme, construct.Byte),
+                                        "signature"     / construct.BytesInteger(signature_size),
+                                        "address_id"    / construct.Int16ub,    # A running count of the message.
+                                                                                # Higher id count means more updated information.
+                                                                                # prevents attackers from remotely
+                                                                                # 'updating' to old addresses
+                                        "address_size"  / construct.Int8ub,
+                                        "address"       / construct.Bytes(construct.this.address_size),   # could be a domain or IP
+                                        "port"          / construct.Int16ub,
+                                        "spread"        / construct.Flag
+                                    )).compile()
+
+    REQUEST_VERSION_MESSAGE =    construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.REQUEST_VERSION.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "crc32"             / construct.BytesInteger(signature_size),
+                                        "listening_port"    / construct.Int16ub,
+                                        "major"             / construct.Int16ub,
+                                        "minor"             / construct.Int16ub,
+                                        "content"           / construct.Enum(construct.Byte, VersionContent),
+                                        "manifest"          / construct.Flag,       # Requests the manifest of the content
+                                        "offset"            / construct.Int32ub,
+                                        "length"            / construct.Int32ub,    # 0 means until the end of the file
+                                        "multicast"         / construct.Flag,       # Requests the content to be streamed
+                                                                                    # to the multicast transfer group
+                                    )).compile()
+
+    REQUEST_UPDATE_MESSAGE =    construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.REQUEST_UPDATE.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "crc32"             / construct.BytesInteger(signature_size),
+                                    )).compile()
+
+    BUSY_MESSAGE =              construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.BUSY.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "crc32"             / construct.BytesInteger(signature_size),
+                                        "listening_port"    / construct.Int16ub,    # Identifies the rejected request
+                                        "retry_after"       / construct.Int16ub,    # In seconds
+                                    )).compile()
+
+    NOT_FOUND_MESSAGE =         construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.NOT_FOUND.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "crc32"             / construct.BytesInteger(signature_size),
+                                        "listening_port"    / construct.Int16ub,    # Identifies the rejected request
+                                    )).compile()
+
+    PEERS_MESSAGE =             construct.FixedSized(message_size,
+                                    construct.Struct(
+                                        "type"              / construct.Const(MessageType.PEERS.value, construct.Byte),
+                                        "scheme"            / construct.Const(scheme, construct.Byte),
+                                        "crc32"             / construct.BytesInteger(signature_size),
+                                        "reply"             / construct.Flag,       # An answer to an exchange, not answered again
+                                        "peers"             / construct.PrefixedArray(construct.Int8ub, construct.Bytes(4)),  # IPv4 addresses
+                                    )).compile()
+
+    formats = dict(
+        SCHEME=scheme,
+        # The type, scheme and signature (or crc32) every message starts with
+        HEADER_SIZE=construct.Byte.sizeof() * 2 + signature_size,
+        GENERIC_MESSAGE=GENERIC_MESSAGE,
+        VERSION_UPDATE_MESSAGE=VERSION_UPDATE_MESSAGE,
+        SERVER_UPDATE_MESSAGE=SERVER_UPDATE_MESSAGE,
+        REQUEST_VERSION_MESSAGE=REQUEST_VERSION_MESSAGE,
+        REQUEST_UPDATE_MESSAGE=REQUEST_UPDATE_MESSAGE,
+        BUSY_MESSAGE=BUSY_MESSAGE,
+        NOT_FOUND_MESSAGE=NOT_FOUND_MESSAGE,
+        PEERS_MESSAGE=PEERS_MESSAGE,
+    )
+    formats["MESSAGE_FORMATS"] = {
+        MessageType.VERSION_UPDATE: VERSION_UPDATE_MESSAGE,
+        MessageType.SERVER_UPDATE: SERVER_UPDATE_MESSAGE,
+        MessageType.REQUEST_VERSION: REQUEST_VERSION_MESSAGE,
+        MessageType.REQUEST_UPDATE: REQUEST_UPDATE_MESSAGE,
+        MessageType.BUSY: BUSY_MESSAGE,
+        MessageType.NOT_FOUND: NOT_FOUND_MESSAGE,
+        MessageType.PEERS: PEERS_MESSAGE,
+    }
+    return formats
+
+
+# The formats depend on the signature scheme (every message carries it, and the size of the signature field follows
+# it), so they are compiled once the settings were loaded, on first use, and again if the scheme changes
+__formats__ = dict()
+
+
+def get_formats():
+    global __formats__
+    key = (int(signing.get_scheme()), settings.SIGNATURE_SIZE, settings.MESSAGE_SIZE)
+    if __formats__.get("key") != key:
+        __formats__ = compile_formats(*key)
+        __formats__["key"] = key
+    return __formats__
+
+
+def get_header_size():
+    return get_formats()["HEADER_SIZE"]
+
+
+def __getattr__(name):
+    formats = get_formats()
+    if name in formats:
+        return formats[name]
+
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+
+# Messages that can be sent by the official update server only, the others carry a crc32 instead of a signature
+SIGNED_MESSAGES = [MessageType.VERSION_UPDATE, MessageType.SERVER_UPDATE]
+
+
+def get_type(message):
+    return message[0]
+
+
+def get_scheme(message):
+    # The scheme follows the type, so it can be read before the message is known to be of the right size
+    return message[1] if len(message) > 1 else None
+
+
+def get_seal(message):
+    # Returns the signature (or crc32) of the message
+    return int.from_bytes(message[construct.Byte.sizeof() * 2:get_header_size()], byteorder='big')
+
+
+def get_sealed_data(message):
+    # The signature (or crc32) covers the type and everything after the header
+    return str(message[0]).encode('ascii') + message[get_header_size():]
 
 
 def calculate_crc(message):
-    m = GENERIC_MESSAGE.parse(message)
-    return zlib.crc32(str(int(m.type)).encode('ascii') + m.data)
+    return zlib.crc32(get_sealed_data(message))
 
 
 def sign_message(message):
-    m = GENERIC_MESSAGE.parse(message)
-    return rsa_signing.sign(str(int(m.type)).encode('ascii') + m.data)
+    return signing.sign(get_sealed_data(message))
+
+
+def parse_message(message):
+    # Parses the message once, with the format of its type
+    message_format = get_formats()["MESSAGE_FORMATS"].get(get_type(message))
+    if message_format is None:
+        raise construct.ConstructError(f"Unknown message type {get_type(message)}")
+
+    try:
+        return message_format.parse(message)
+    except struct.error as e:
+        # Compiled formats report a truncated message as a struct error
+        raise construct.ConstructError(str(e))
+
+
+def build_message(message_format, values):
+    # Builds the message once (with an empty signature or crc32), and seals it in place
+    message = message_format.build(values)
+    if get_type(message) in SIGNED_MESSAGES:
+        seal = sign_message(message)
+    else:
+        seal = calculate_crc(message)
+    return message[:construct.Byte.sizeof() * 2] + seal.to_bytes(settings.SIGNATURE_SIZE, byteorder='big') + \
+        message[get_header_size():]
@@ -1,24 +1,337 @@
+import threading
+import contextlib
 
-import os
-import winreg
+try:
+    import winreg
+except ImportError:
+    # Not on Windows, only the in-memory backend is available
+    winreg = None
 
+try:
+    import win32api
+    import win32con
+    import win32event
+except ImportError:
+    # Without pywin32 the registry can't be watched, so its values are never cached
+    win32api = None
 
-def create_key(path):
-    registry_key = winreg.CreateKey(winreg.HKEY_LOCAL_MACHINE, path)
-    winreg.CloseKey(registry_key)
+MISSING = object()  # Marks a value that does not exist (in the cache or in a batch)
 
 
-def key_exists(path):
-    registry_key = None
-    try:
+def split_path(path):
+    key_path, _, name = path.rpartition("\\")
+    return key_path, name
+
+
+class WinregBackend(object):
+    # Reads and writes values under HKEY_LOCAL_MACHINE
+    def create_key(self, path):
+        registry_key = winreg.CreateKey(winreg.HKEY_LOCAL_MACHINE, path)
+        winreg.CloseKey(registry_key)
+
+    def key_exists(self, path):
+        registry_key = None
+        try:
+            registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
+            return True
+        except FileNotFoundError:
+            return False
+        finally:
+            if registry_key:
+                winreg.CloseKey(registry_key)
+
+    def delete_key(self, path):
+        winreg.DeleteKey(winreg.HKEY_LOCAL_MACHINE, path)
+
+    def get_all_sub_values(self, path):
         registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
-        return True
-    except FileNotFoundError:
-        return False
-    finally:
-        if registry_key:
+        items_count = winreg.QueryInfoKey(registry_key)[1]
+
+        items = []
+        for i in range(items_count):
+            item = winreg.EnumValue(registry_key, i)[0]
+            items.append(item)
+
+        winreg.CloseKey(registry_key)
+        return items
+
+    def get_all_sub_keys(self, path):
+        registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
+        items_count = winreg.QueryInfoKey(registry_key)[0]
+
+        items = []
+        for i in range(items_count):
+            item = winreg.EnumKey(registry_key, i)[0]
+            items.append(item)
+
+        winreg.CloseKey(registry_key)
+        return items
+
+    def get_value(self, path):
+        path, name = split_path(path)
+        registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
+        try:
+            value, reg_type = winreg.QueryValueEx(registry_key, name)
+        finally:
             winreg.CloseKey(registry_key)
 
+        if reg_type == winreg.REG_DWORD:
+            value = int(value)
+        elif reg_type == winreg.REG_QWORD:
+            value = int(value)
+        elif reg_type == winreg.REG_BINARY:
+            value = int.from_bytes(value, "big")
+
+        return value
+
+    def commit(self, changes):
+        # Applies (path, value) changes (MISSING deletes the value), opening each key once
+        changes_by_key = dict()
+        for path, value in changes:
+            key_path, name = split_path(path)
+            changes_by_key.setdefault(key_path, []).append((name, value))
+
+        for key_path, key_changes in changes_by_key.items():
+            registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, key_path, 0, winreg.KEY_WRITE)
+            try:
+                for name, value in key_changes:
+                    if value is MISSING:
+                        winreg.DeleteValue(registry_key, name)
+                    else:
+                        self.set_value(registry_key, name, value)
+            finally:
+                winreg.CloseKey(registry_key)
+
+    @staticmethod
+    def set_value(registry_key, name, value):
+        if type(value) is int:
+            if value < 2 ** 32:
+                reg_type = winreg.REG_DWORD
+            elif value < 2 ** 64:
+                reg_type = winreg.REG_QWORD
+            else:
+                reg_type = winreg.REG_BINARY
+                value = value.to_bytes((value.bit_length() + 7) // 8, "big")
+        else:
+            reg_type = winreg.REG_SZ
+
+        winreg.SetValueEx(registry_key, name, 0, reg_type, value)
+
+    def watch(self, path, on_change):
+        if win32api is None:
+            return None
+        watcher = RegistryWatcher(path, on_change)
+        watcher.start()
+        return watcher
+
+
+class RegistryWatcher(threading.Thread):
+    # Calls on_change whenever a value or a key under the given key is changed (by any process)
+    def __init__(self, path, on_change):
+        super().__init__(daemon=True)
+        self.on_change = on_change
+        self.registry_key = win32api.RegOpenKeyEx(win32con.HKEY_LOCAL_MACHINE, path, 0, win32con.KEY_NOTIFY)
+        self.changed_event = win32event.CreateEvent(None, False, False, None)
+        self.stop_event = win32event.CreateEvent(None, True, False, None)
+
+        # Armed before the cache is used, so no change is missed
+        self.arm()
+
+    def arm(self):
+        win32api.RegNotifyChangeKeyValue(self.registry_key, True,
+                                         win32con.REG_NOTIFY_CHANGE_NAME | win32con.REG_NOTIFY_CHANGE_LAST_SET,
+                                         self.changed_event, True)
+
+    def run(self):
+        while True:
+            result = win32event.WaitForMultipleObjects([self.changed_event, self.stop_event], False,
+                                                       win32event.INFINITE)
+            if result != win32event.WAIT_OBJECT_0:
+                break
+
+            # Armed again before invalidating, so a change made meanwhile invalidates the cache once more
+            self.arm()
+            self.on_change()
+
+        self.registry_key.Close()
+
+    def stop(self):
+        win32event.SetEvent(self.stop_event)
+
+
+class MemoryBackend(object):
+    # Keeps the registry in a dict, for running and benchmarking without Windows.
+    # Nothing but this process changes it, so it never has to be watched.
+    def __init__(self):
+        self.keys = {""}
+        self.values = dict()
+
+    def create_key(self, path):
+        while path not in self.keys:
+            self.keys.add(path)
+            path = split_path(path)[0]
+
+    def key_exists(self, path):
+        return path in self.keys
+
+    def delete_key(self, path):
+        if path not in self.keys:
+            raise FileNotFoundError(path)
+        self.keys.remove(path)
+
+    def get_all_sub_values(self, path):
+        if path not in self.keys:
+            raise FileNotFoundError(path)
+        return [split_path(value_path)[1] for value_path in self.values if split_path(value_path)[0] == path]
+
+    def get_all_sub_keys(self, path):
+        if path not in self.keys:
+            raise FileNotFoundError(path)
+        return [split_path(key_path)[1] for key_path in self.keys if key_path and split_path(key_path)[0] == path]
+
+    def get_value(self, path):
+        if path not in self.values:
+            raise FileNotFoundError(path)
+        return self.values[path]
+
+    def commit(self, changes):
+        for path, value in changes:
+            if split_path(path)[0] not in self.keys:
+                raise FileNotFoundError(path)
+            if value is MISSING:
+                del self.values[path]
+            else:
+                self.values[path] = value
+
+    def watch(self, path, on_change):
+        return MemoryWatcher()
+
+
+class MemoryWatcher(object):
+    def stop(self):
+        pass
+
+
+class RegistryCache(object):
+    # Keeps the values read from the backend in memory, and writes through to the backend
+    # (at once, or when a batch ends). Values are only cached while the registry is watched,
+    # since otherwise a change made by another process would never be noticed.
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.RLock()
+        self.values = dict()  # Cached values, by path (MISSING for values known not to exist)
+        self.pending = None  # Changes of the current batch, by path
+        self.watcher = None
+
+    def get_value(self, path):
+        with self.lock:
+            if self.pending is not None and path in self.pending:
+                value = self.pending[path]
+            elif self.watcher is not None and path in self.values:
+                value = self.values[path]
+            else:
+                try:
+                    value = self.backend.get_value(path)
+                except FileNotFoundError:
+                    value = MISSING
+                if self.watcher is not None:
+                    self.values[path] = value
+
+        if value is MISSING:
+            raise FileNotFoundError(path)
+        return value
+
+    def set_value(self, path, value):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[path] = value
+            else:
+                self.commit([(path, value)])
+
+    def delete(self, path):
+        with self.lock:
+            if self.pending is not None:
+                self.pending[path] = MISSING
+            else:
+                self.commit([(path, MISSING)])
+
+    def commit(self, changes):
+        with self.lock:
+            # Forgotten first, so a failed commit leaves no stale value behind
+            for path, value in changes:
+                self.values.pop(path, None)
+
+            self.backend.commit(changes)
+
+            if self.watcher is not None:
+                self.values.update(changes)
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Writes of the batch are committed together when it ends, and dropped if it fails.
+        # Other threads wait for the batch to end before using the registry.
+        with self.lock:
+            if self.pending is not None:
+                # Committed by the outer batch
+                yield
+                return
+
+            self.pending = dict()
+            try:
+                yield
+                changes = list(self.pending.items())
+            finally:
+                self.pending = None
+            self.commit(changes)
+
+    def invalidate(self):
+        with self.lock:
+            self.values.clear()
+
+    def watch(self, path):
+        # Starts caching values, returns False if the registry can't be watched
+        with self.lock:
+            if self.watcher is None and self.backend.key_exists(path):
+                self.watcher = self.backend.watch(path, self.invalidate)
+                self.values.clear()
+            return self.watcher is not None
+
+    def unwatch(self):
+        with self.lock:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+                self.values.clear()
+
+
+cache = RegistryCache(WinregBackend() if winreg is not None else MemoryBackend())
+
+
+def use_backend(backend):
+    global cache
+    cache.unwatch()
+    cache = RegistryCache(backend)
+
+
+def watch(path):
+    return cache.watch(path)
+
+
+def unwatch():
+    cache.unwatch()
+
+
+def batch():
+    return cache.batch()
+
+
+def create_key(path):
+    cache.backend.create_key(path)
+
+
+def key_exists(path):
+    return cache.backend.key_exists(path)
+
 
 def delete_key_recursive(path):
     keys = get_all_sub_keys(path)
@@ -31,90 +344,32 @@ def delete_key_recursive(path):
         value_path = rf"{path}\{value}"
         delete(value_path)
 
-    winreg.DeleteKey(winreg.HKEY_LOCAL_MACHINE, path)
+    cache.backend.delete_key(path)
 
 
 def exists(path):
-    name = os.path.basename(path)
-    path = os.path.dirname(path)
-    registry_key = None
     try:
-        registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
-        value, reg_type = winreg.QueryValueEx(registry_key, name)
+        cache.get_value(path)
         return True
     except FileNotFoundError:
         return False
-    finally:
-        if registry_key:
-            winreg.CloseKey(registry_key)
 
 
 def delete(path):
-    name = os.path.basename(path)
-    path = os.path.dirname(path)
-    registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_WRITE)
-    winreg.DeleteValue(registry_key, name)
-    winreg.CloseKey(registry_key)
+    cache.delete(path)
 
 
 def get_all_sub_values(path):
-    registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
-    items_count = winreg.QueryInfoKey(registry_key)[1]
-
-    items = []
-    for i in range(items_count):
-        item = winreg.EnumValue(registry_key, i)[0]
-        items.append(item)
-
-    winreg.CloseKey(registry_key)
-    return items
+    return cache.backend.get_all_sub_values(path)
 
 
 def get_all_sub_keys(path):
-    registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
-    items_count = winreg.QueryInfoKey(registry_key)[0]
-
-    items = []
-    for i in range(items_count):
-        item = winreg.EnumKey(registry_key, i)[0]
-        items.append(item)
-
-    winreg.CloseKey(registry_key)
-    return items
+    return cache.backend.get_all_sub_keys(path)
 
 
 def get_value(path):
-    name = os.path.basename(path)
-    path = os.path.dirname(path)
-    registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_READ)
-    value, reg_type = winreg.QueryValueEx(registry_key, name)
-    winreg.CloseKey(registry_key)
-
-    if reg_type == winreg.REG_DWORD:
-        value = int(value)
-    elif reg_type == winreg.REG_QWORD:
-        value = int(value)
-    elif reg_type == winreg.REG_BINARY:
-        value = int.from_bytes(value, "big")
-
-    return value
+    return cache.get_value(path)
 
 
 def set_value(path, value):
-    name = os.path.basename(path)
-    path = os.path.dirname(path)
-    registry_key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, path, 0, winreg.KEY_WRITE)
-
-    if type(value) is int:
-        if value < 2 ** 32:
-            reg_type = winreg.REG_DWORD
-        elif value < 2 ** 64:
-            reg_type = winreg.REG_QWORD
-        else:
-            reg_type = winreg.REG_BINARY
-            value = value.to_bytes((value.bit_length() + 7) // 8, "big")
-    else:
-        reg_type = winreg.REG_SZ
-
-    winreg.SetValueEx(registry_key, name, 0, reg_type, value)
-    winreg.CloseKey(registry_key)
+    cache.set_value(path, value)
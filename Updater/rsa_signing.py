@@ -1,48 +1,122 @@
+import functools
+
 from Crypto.PublicKey import RSA
 
 from Updater import registry
 from Updater import settings
 
 
+def hash_to_int(hash_object):
+    return int.from_bytes(hash_object.digest(), byteorder='big')
+
+
+class SigningContext(object):
+    # Signs with a parsed private key. Signing uses the Chinese Remainder Theorem,
+    # two exponentiations modulo p and q are about 3 times faster than one modulo n.
+    def __init__(self, private_key, public_key, n):
+        # The public exponent is needed to recover the primes from the private exponent
+        key = RSA.construct((n, public_key, private_key))
+        self.n = n
+        self.p = key.p
+        self.q = key.q
+        self.dp = private_key % (key.p - 1)
+        self.dq = private_key % (key.q - 1)
+        self.q_inv = pow(key.q, -1, key.p)
+
+    @staticmethod
+    def from_registry():
+        return load_signing_context(registry.get_value(settings.RSA_PRIVATE_REGISTRY),
+                                    registry.get_value(settings.RSA_PUBLIC_REGISTRY),
+                                    registry.get_value(settings.RSA_MODULO_REGISTRY))
+
+    def sign_int(self, value):
+        m1 = pow(value, self.dp, self.p)
+        m2 = pow(value, self.dq, self.q)
+        h = (self.q_inv * (m1 - m2)) % self.p
+        return m2 + h * self.q
+
+    def sign(self, data):
+        return self.sign_int(hash_to_int(settings.HASH_MODULE(data)))
+
+    def sign_hash(self, hash_object):
+        return self.sign_int(hash_to_int(hash_object))
+
+
+class VerifyingContext(object):
+    # Validates signatures with a parsed public key
+    def __init__(self, public_key, n):
+        self.public_key = public_key
+        self.n = n
+
+    @staticmethod
+    def from_registry():
+        return load_verifying_context(registry.get_value(settings.RSA_PUBLIC_REGISTRY),
+                                      registry.get_value(settings.RSA_MODULO_REGISTRY))
+
+    def validate_int(self, value, signature):
+        return value == pow(signature, self.public_key, self.n)
+
+    def validate(self, data, signature):
+        return self.validate_int(hash_to_int(settings.HASH_MODULE(data)), signature)
+
+    def validate_hash(self, hash_object, signature):
+        return self.validate_int(hash_to_int(hash_object), signature)
+
+
+# Keys are kept in the registry as hex strings, a context is parsed once for every key
+@functools.lru_cache(maxsize=4)
+def load_signing_context(hex_private_key, hex_public_key, hex_n):
+    return SigningContext(int(hex_private_key, 16), int(hex_public_key, 16), int(hex_n, 16))
+
+
+@functools.lru_cache(maxsize=4)
+def load_verifying_context(hex_public_key, hex_n):
+    return VerifyingContext(int(hex_public_key, 16), int(hex_n, 16))
+
+
 def sign(data, private_key=None, n=None):
+    if private_key is None and n is None:
+        return SigningContext.from_registry().sign(data)
     if private_key is None:
         private_key = int(registry.get_value(settings.RSA_PRIVATE_REGISTRY), 16)
     if n is None:
         n = int(registry.get_value(settings.RSA_MODULO_REGISTRY), 16)
 
-    calculated_hash = int.from_bytes(settings.HASH_MODULE(data).digest(), byteorder='big')
+    calculated_hash = hash_to_int(settings.HASH_MODULE(data))
     signature = pow(calculated_hash, private_key, n)
     return signature
 
 
 def sign_hash(hash_object, private_key=None, n=None):
+    if private_key is None and n is None:
+        return SigningContext.from_registry().sign_hash(hash_object)
     if private_key is None:
         private_key = int(registry.get_value(settings.RSA_PRIVATE_REGISTRY), 16)
     if n is None:
         n = int(registry.get_value(settings.RSA_MODULO_REGISTRY), 16)
 
-    calculated_hash = int.from_bytes(hash_object.digest(), byteorder='big')
+    calculated_hash = hash_to_int(hash_object)
     signature = pow(calculated_hash, private_key, n)
     return signature
 
 
 def validate(data, signature, public_key=None, n=None):
+    if public_key is None and n is None:
+        return VerifyingContext.from_registry().validate(data, signature)
     if public_key is None:
         public_key = int(registry.get_value(settings.RSA_PUBLIC_REGISTRY), 16)
     if n is None:
         n = int(registry.get_value(settings.RSA_MODULO_REGISTRY), 16)
 
-    calculated_hash = int.from_bytes(settings.HASH_MODULE(data).digest(), byteorder='big')
-    hash_from_signature = pow(signature, public_key, n)
-    return calculated_hash == hash_from_signature
+    return VerifyingContext(public_key, n).validate(data, signature)
 
 
 def validate_hash(hash_object, signature, public_key=None, n=None):
+    if public_key is None and n is None:
+        return VerifyingContext.from_registry().validate_hash(hash_object, signature)
     if public_key is None:
         public_key = int(registry.get_value(settings.RSA_PUBLIC_REGISTRY), 16)
     if n is None:
         n = int(registry.get_value(settings.RSA_MODULO_REGISTRY), 16)
 
-    calculated_hash = int.from_bytes(hash_object.digest(), byteorder='big')
-    hash_from_signature = pow(signature, public_key, n)
-    return calculated_hash == hash_from_signature
+    return VerifyingContext(public_key, n).validate_hash(hash_object, signature)
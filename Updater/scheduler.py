@@ -0,0 +1,77 @@
+import time
+import asyncio
+import collections
+
+
+class UploadScheduler(object):
+    # Limits the number of uploads that run at the same time.
+    # Waiting uploads are started round robin between the peers that requested them,
+    # so a peer that requests many ranges at once doesn't starve the other peers.
+    # An upload that waits longer than the timeout is rejected instead, its requester won't wait for it much longer.
+    def __init__(self, spawn, slots, queue_size, timeout):
+        self.spawn = spawn
+        self.slots = slots
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.queues = collections.OrderedDict()  # Waiting (deadline, upload, reject), by peer (in round robin order)
+        self.expiration = None  # Timer of the next waiting upload that expires
+
+    def request(self, peer, upload, reject):
+        # Starts or queues the upload (a coroutine function). Returns False if the queue is full.
+        # reject is called if the upload is dropped from the queue.
+        if self.active < self.slots:
+            self.start(upload)
+            return True
+
+        if self.waiting >= self.queue_size:
+            return False
+
+        self.queues.setdefault(peer, collections.deque()).append((time.monotonic() + self.timeout, upload, reject))
+        self.waiting += 1
+        if self.expiration is None:
+            self.expiration = asyncio.get_running_loop().call_later(self.timeout, self.expire)
+        return True
+
+    def start(self, upload):
+        self.active += 1
+        task = self.spawn(upload())
+        task.add_done_callback(self.on_upload_done)
+
+    def on_upload_done(self, task):
+        self.active -= 1
+        self.start_next()
+
+    def start_next(self):
+        while self.active < self.slots and len(self.queues) != 0:
+            # Takes the first upload of the next peer, and moves the peer to the end of the line
+            peer, uploads = self.queues.popitem(last=False)
+            deadline, upload, reject = uploads.popleft()
+            if len(uploads) != 0:
+                self.queues[peer] = uploads
+
+            self.waiting -= 1
+            if deadline <= time.monotonic():
+                reject()
+            else:
+                self.start(upload)
+
+    def expire(self):
+        # Rejects the uploads that waited too long. The uploads of every peer wait in the order they were requested,
+        # so only the first ones can expire.
+        self.expiration = None
+        now = time.monotonic()
+        next_deadline = None
+        for peer in list(self.queues):
+            uploads = self.queues[peer]
+            while len(uploads) != 0 and uploads[0][0] <= now:
+                uploads.popleft()[2]()
+                self.waiting -= 1
+            if len(uploads) == 0:
+                del self.queues[peer]
+            elif next_deadline is None or uploads[0][0] < next_deadline:
+                next_deadline = uploads[0][0]
+
+        if next_deadline is not None:
+            self.expiration = asyncio.get_running_loop().call_later(next_deadline - now, self.expire)
@@ -3,7 +3,6 @@ import sys
 import win32serviceutil
 import win32service
 import win32event
-import win32file
 import servicemanager
 import logging
 
@@ -11,7 +10,6 @@ import logging
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from Updater import settings
-from Updater import registry
 from Updater import updater
 
 
@@ -45,30 +43,7 @@ class UpdaterServerSvc(win32serviceutil.ServiceFramework):
 
     @staticmethod
     def init_registry():
-        if not registry.exists(settings.REGISTRY_PATH):
-            registry.create_key(settings.REGISTRY_PATH)
-        if not registry.exists(settings.AUTO_INSTALLATIONS_REGISTRY):
-            registry.set_value(settings.AUTO_INSTALLATIONS_REGISTRY, settings.AUTO_INSTALLATIONS)
-        if not registry.exists(settings.UPDATING_SERVER_REGISTRY):
-            registry.set_value(settings.UPDATING_SERVER_REGISTRY, settings.UPDATING_SERVER)
-        if not registry.exists(settings.PORT_REGISTRY):
-            registry.set_value(settings.PORT_REGISTRY, settings.PORT)
-        if not registry.exists(settings.RSA_MODULO_REGISTRY):
-            registry.set_value(settings.RSA_MODULO_REGISTRY, settings.RSA_MODULO)
-        if not registry.exists(settings.RSA_PUBLIC_REGISTRY):
-            registry.set_value(settings.RSA_PUBLIC_REGISTRY, settings.PUBLIC_KEY)
-        if not registry.exists(settings.UPDATE_MAJOR_REGISTRY):
-            registry.set_value(settings.UPDATE_MAJOR_REGISTRY, settings.UPDATE_MAJOR)
-        if not registry.exists(settings.UPDATE_MINOR_REGISTRY):
-            registry.set_value(settings.UPDATE_MINOR_REGISTRY, settings.UPDATE_MINOR)
-        if not registry.exists(settings.VERSION_MAJOR_REGISTRY):
-            registry.set_value(settings.VERSION_MAJOR_REGISTRY, settings.VERSION_MAJOR)
-        if not registry.exists(settings.VERSION_MINOR_REGISTRY):
-            registry.set_value(settings.VERSION_MINOR_REGISTRY, settings.VERSION_MINOR)
-        if not registry.exists(settings.ADDRESS_ID_REGISTRY):
-            registry.set_value(settings.ADDRESS_ID_REGISTRY, settings.ADDRESS_ID)
-        if not registry.exists(settings.SETTINGS_REGISTRY):
-            registry.set_value(settings.SETTINGS_REGISTRY, settings.SETTINGS_PATH)
+        updater.init_registry()
 
     @staticmethod
     def init():
@@ -85,6 +60,10 @@ class UpdaterServerSvc(win32serviceutil.ServiceFramework):
         self.running = False
         self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
         win32event.SetEvent(self.stop_event_handle)
+        if self.updater:
+            # Stops the event loop of the updater (called from the service control thread)
+            logging.info("Request to stop service detected. Stopping service...")
+            self.updater.stop()
 
     def start(self):
         try:
@@ -101,33 +80,8 @@ class UpdaterServerSvc(win32serviceutil.ServiceFramework):
         self.updater = updater.Updater()
         self.running = True
 
-        # Handling events...
-        while self.running:
-
-            # Creates an event to handle IO on the socket
-            socket_event = win32event.CreateEvent(None, True, False, None)
-            win32file.WSAEventSelect(self.updater.management_socket, socket_event, win32file.FD_READ | win32file.FD_CLOSE)
-
-            # Waits for either an event on the socket or a stop request of the service, waits indefinitely
-            logging.info("Waiting for packet...")
-            event_result = win32event.WaitForMultipleObjects([socket_event, self.stop_event_handle], 0, win32event.INFINITE)
-
-            if event_result == win32event.WAIT_TIMEOUT:
-                # Timeout occurred, ignoring...
-                pass
-            elif event_result == win32event.WAIT_OBJECT_0 + 0:
-                # socket_event occurred, The socket has some IO that needs to be handled
-                self.updater.receive_message()
-                if self.updater.message:
-                    self.updater.handle_message()
-            elif event_result == win32event.WAIT_OBJECT_0 + 1:
-                # stop_event occurred
-                logging.info("Request to stop service detected. Stopping service...")
-                self.stop()
-            else:
-                # Error occurred
-                logging.critical("WaitForMultipleObjects failed!")
-                self.stop()
+        # Handles the management socket and all the transfers on the updater's event loop, until the service stops
+        self.updater.run()
 
 
 if __name__ == '__main__':
@@ -14,16 +14,58 @@ else:
     CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 INITIAL_SETTINGS_PATH = f"{CURRENT_DIR}{os.path.sep}settings.json"
-PROGRAM_FILES = os.environ["ProgramFiles"]
+# Outside of windows (running the updater as a plain process) the software is placed in the home folder
+PROGRAM_FILES = os.environ.get("ProgramFiles", os.path.expanduser("~"))
 HASH_MODULE = hashlib.sha512
 
 __values__ = dict(SOFTWARE_NAME="Ex",
                   PROGRAM="ex.exe",
                   UPDATER_NAME="Updater",
                   LAUNCHER_NAME="launcher.exe",
+                  SIGNATURE_SCHEME="rsa",  # "rsa" or "ed25519", all nodes must use the same scheme
                   RSA_KEY_SIZE=1024,  # in bits
                   VERSION_CHUNK_SIZE=1460,  # MTU - Headers size (assuming MTU=1500)
                   CONNECTION_TIMEOUT=10,
+                  MANIFEST_CHUNK_SIZE=256 * 1024,  # Size of the chunks that are verified (and re-fetched) separately
+                  MANIFEST_FILES_SHARE=8,  # The hashes of the files in a manifest take up to 1/8 of the update size
+                  MANIFEST_FILES_MAX_SIZE=16 * 1024 * 1024,  # ...and never more than 16 MB (about 80,000 files)
+                  DOWNLOAD_ATTEMPTS=3,
+                  EXTRACTION_WORKERS=0,  # Threads the launcher extracts an update with (0 uses all the cores)
+                  EXTRACTION_BATCH_SIZE=4 * 1024 * 1024,  # Members smaller than this are extracted in batches
+                  EXTRACTION_BATCH_MEMBERS=64,  # Maximal number of members in a single batch
+                  COMPRESSION_WORKERS=0,  # Threads the installer compresses an update with (0 uses all the cores)
+                  COMPRESSION_SPOOL_SIZE=16 * 1024 * 1024,  # Larger files are compressed into a temporary file
+                  STORED_EXTENSIONS=[".zip", ".7z", ".rar", ".gz", ".bz2", ".xz", ".zst", ".cab",
+                                     ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".ogg", ".flac", ".aac",
+                                     ".m4a", ".mp4", ".mkv", ".avi", ".mov", ".webm"],  # Not compressed again
+                  LZMA_EXTENSIONS=[".exe", ".dll", ".pyd", ".sys"],  # Compressed with LZMA, the rest with deflate
+                  STAGING_INTERVAL=1,  # Seconds between extractions of the members of an update that is downloaded
+                  SWARM_MAX_PEERS=8,  # Maximal number of peers a single update is downloaded from in parallel
+                  SWARM_RANGE_CHUNKS=16,  # Number of chunks requested from a peer at once
+                  SWARM_PEER_FAILURES=2,  # Number of failed ranges after which a peer is no longer used
+                  SWARM_PEER_BUSY_RETRIES=10,  # Number of "busy" answers after which a peer is no longer used
+                  UPLOAD_SLOTS=4,  # Number of uploads that are sent at the same time
+                  UPLOAD_QUEUE_SIZE=64,  # Number of uploads that can wait for a slot, others are answered with "busy"
+                  UPLOAD_RETRY_AFTER=5,  # Seconds a rejected requester should wait before asking again
+                  BUSY_MAX_WAIT=30,  # Seconds a "busy" answer can make a downloader wait at most (it isn't signed)
+                  UPLOAD_QUEUE_TIMEOUT=5,  # Seconds an upload waits for a slot (less than CONNECTION_TIMEOUT, the requester waits that long)
+                  DUPLICATES_CACHE_SIZE=1024,  # Number of announcements remembered, so their copies are dropped
+                  DUPLICATES_TTL=60,  # Seconds after which a copy of an announcement is handled again
+                  PROPAGATION="broadcast",  # "broadcast" spreads announcements to subnets, "gossip" to random peers
+                  GOSSIP_FANOUT=10,  # Number of peers an announcement is forwarded to
+                  GOSSIP_MAX_PEERS=64,  # Number of peers a node remembers (besides the seeds)
+                  GOSSIP_PEERS=[],  # Addresses of seed peers, announcements of the server are sent to all of them
+                  GOSSIP_EXCHANGE_SIZE=8,  # Number of peers sent in a single exchange (fits the smallest message)
+                  GOSSIP_EXCHANGE_INTERVAL=60,  # Seconds between exchanges of peers with a random known peer
+                  MULTICAST_GROUPS=[],  # IPv4 / IPv6 groups for announcements (for example "239.255.85.85", "ff15::8585")
+                  MULTICAST_TTL=8,  # Number of routers a multicast announcement may cross
+                  INTERFACES_TTL=60,  # Seconds the addresses of the interfaces are kept (unless they change before)
+                  MULTICAST_TRANSFER_GROUP="",  # IPv4 group the update server streams updates to, empty disables it
+                  MULTICAST_TRANSFER_PORT=55556,
+                  MULTICAST_TRANSFER_RATE=8 * 1024 * 1024,  # Bytes per second a multicast transfer is streamed at
+                  MULTICAST_TRANSFER_IDLE=5,  # Seconds without packets after which a receiver stops waiting for them
+                  FEC_BLOCK_SIZE=1024,  # Size of the blocks a chunk is streamed in (one block per packet)
+                  FEC_GROUP_SIZE=16,  # Number of blocks protected by a single parity block
 
                   # Default registry values
                   AUTO_INSTALLATIONS=0,
@@ -36,14 +78,34 @@ __values__ = dict(SOFTWARE_NAME="Ex",
                   ADDRESS_ID=1,
                   )
 
-__values__.update(dict(
-                    # Signature is also used as crc32 sometimes, so it needs to be at least 4 bytes long
-                    SIGNATURE_SIZE=max(__values__["RSA_KEY_SIZE"] // 8, 4),  # in bytes
-                    ))
 
-__values__.update(dict(
-                    MESSAGE_SIZE=__values__["SIGNATURE_SIZE"] * 2 + 50,
-                    ))
+def get_signature_size(scheme, rsa_key_size):
+    # Signature is also used as crc32 sometimes, so it needs to be at least 4 bytes long.
+    # Ed25519 signatures are always 64 bytes long.
+    if scheme == "ed25519":
+        return 64
+    if scheme == "rsa":
+        return max(rsa_key_size // 8, 4)  # in bytes
+    raise ValueError(f"Unknown signature scheme: {scheme}")
+
+
+def get_message_size(signature_size):
+    # A version update carries the header, update and delta signatures
+    return signature_size * 3 + 50
+
+
+# Settings that are derived from other settings, never saved (older versions saved them, those values are ignored)
+DERIVED_SETTINGS = ["SIGNATURE_SIZE", "MESSAGE_SIZE"]
+
+
+def resolve_signature_sizes():
+    # The sizes follow the scheme, which the settings file might have changed
+    global __values__
+    signature_size = get_signature_size(__values__["SIGNATURE_SCHEME"], __values__["RSA_KEY_SIZE"])
+    __values__.update(SIGNATURE_SIZE=signature_size, MESSAGE_SIZE=get_message_size(signature_size))
+
+
+resolve_signature_sizes()
 
 
 def init_settings(save=True, load=True):
@@ -61,6 +123,7 @@ def init_settings(save=True, load=True):
     # Load existing settings
     if load:
         load_settings()
+    resolve_signature_sizes()
 
     # Setting default settings values, if they don't appear in the settings.json file already
 
@@ -71,18 +134,24 @@ def init_settings(save=True, load=True):
     __values__.setdefault("SETTINGS_PATH", rf"{__values__['UPDATER_PATH']}{os.path.sep}settings.json")
     __values__.setdefault("LOGGER_PATH", rf"{__values__['UPDATER_PATH']}{os.path.sep}log.txt")
     __values__.setdefault("UPDATE_PATH", rf"{__values__['UPDATER_PATH']}{os.path.sep}update.zip")
+    __values__.setdefault("INSTALLED_MANIFEST_PATH", rf"{__values__['UPDATER_PATH']}{os.path.sep}installed.json")
     __values__.setdefault("AUTO_INSTALLATIONS_REGISTRY", rf"{__values__['REGISTRY_PATH']}\auto_update")
     __values__.setdefault("UPDATING_SERVER_REGISTRY", rf"{__values__['REGISTRY_PATH']}\update_server")
     __values__.setdefault("PORT_REGISTRY", rf"{__values__['REGISTRY_PATH']}\port")
     __values__.setdefault("RSA_MODULO_REGISTRY", rf"{__values__['REGISTRY_PATH']}\rsa_modulo")
     __values__.setdefault("RSA_PUBLIC_REGISTRY", rf"{__values__['REGISTRY_PATH']}\rsa_public")
     __values__.setdefault("RSA_PRIVATE_REGISTRY", rf"{__values__['REGISTRY_PATH']}\rsa_private")
+    __values__.setdefault("ED25519_PUBLIC_REGISTRY", rf"{__values__['REGISTRY_PATH']}\ed25519_public")
+    __values__.setdefault("ED25519_PRIVATE_REGISTRY", rf"{__values__['REGISTRY_PATH']}\ed25519_private")
     __values__.setdefault("UPDATE_MAJOR_REGISTRY", rf"{__values__['REGISTRY_PATH']}\update_major")
     __values__.setdefault("UPDATE_MINOR_REGISTRY", rf"{__values__['REGISTRY_PATH']}\update_minor")
     __values__.setdefault("VERSION_MAJOR_REGISTRY", rf"{__values__['REGISTRY_PATH']}\version_major")
     __values__.setdefault("VERSION_MINOR_REGISTRY", rf"{__values__['REGISTRY_PATH']}\version_minor")
     __values__.setdefault("ADDRESS_ID_REGISTRY", rf"{__values__['REGISTRY_PATH']}\address_id")
     __values__.setdefault("UPDATE_REGISTRY_FORMAT", rf"{__values__['REGISTRY_PATH']}\Update_{{}}")
+    __values__.setdefault("DELTA_REGISTRY_FORMAT", rf"{__values__['REGISTRY_PATH']}\Delta_{{}}")
+    __values__.setdefault("STAGING_REGISTRY_FORMAT", rf"{__values__['REGISTRY_PATH']}\Staging_{{}}")
+    __values__.setdefault("SKIP_DELTA_REGISTRY", rf"{__values__['REGISTRY_PATH']}\skip_delta")
 
     # Saves the settings, if they should be saved
     if save:
@@ -114,7 +183,7 @@ def save_settings():
 
     try:
         with open(settings_path, "w") as settings_file:
-            data = json.dumps(__values__)
+            data = json.dumps({name: value for name, value in __values__.items() if name not in DERIVED_SETTINGS})
             settings_file.write(data)
     except PermissionError:
         logging.critical(f"Failed to write settings file due to PermissionError: {__values__['SETTINGS_PATH']}", exc_info=True)
@@ -0,0 +1,110 @@
+import enum
+import functools
+
+from Crypto.PublicKey import ECC
+from Crypto.Signature import eddsa
+
+from Updater import registry
+from Updater import settings
+from Updater import rsa_signing
+
+ED25519_SIGNATURE_SIZE = 64  # in bytes
+
+
+class SignatureScheme(enum.IntEnum):
+    RSA = 1
+    ED25519 = 2
+
+
+class Ed25519SigningContext(object):
+    # Signs with a parsed Ed25519 private key (the 32 bytes seed)
+    def __init__(self, private_key):
+        self.signer = eddsa.new(eddsa.import_private_key(private_key), "rfc8032")
+
+    @staticmethod
+    def from_registry():
+        return load_ed25519_signing_context(registry.get_value(settings.ED25519_PRIVATE_REGISTRY))
+
+    def sign(self, data):
+        return int.from_bytes(self.signer.sign(data), byteorder='big')
+
+    def sign_hash(self, hash_object):
+        return self.sign(hash_object.digest())
+
+
+class Ed25519VerifyingContext(object):
+    # Validates signatures with a parsed Ed25519 public key
+    def __init__(self, public_key):
+        self.verifier = eddsa.new(eddsa.import_public_key(public_key), "rfc8032")
+
+    @staticmethod
+    def from_registry():
+        return load_ed25519_verifying_context(registry.get_value(settings.ED25519_PUBLIC_REGISTRY))
+
+    def validate(self, data, signature):
+        try:
+            self.verifier.verify(data, signature.to_bytes(ED25519_SIGNATURE_SIZE, byteorder='big'))
+            return True
+        except (ValueError, OverflowError):
+            return False
+
+    def validate_hash(self, hash_object, signature):
+        return self.validate(hash_object.digest(), signature)
+
+
+# Keys are kept in the registry as hex strings, a context is parsed once for every key
+@functools.lru_cache(maxsize=4)
+def load_ed25519_signing_context(hex_private_key):
+    return Ed25519SigningContext(bytes.fromhex(hex_private_key))
+
+
+@functools.lru_cache(maxsize=4)
+def load_ed25519_verifying_context(hex_public_key):
+    return Ed25519VerifyingContext(bytes.fromhex(hex_public_key))
+
+
+SIGNING_CONTEXTS = {
+    SignatureScheme.RSA: rsa_signing.SigningContext,
+    SignatureScheme.ED25519: Ed25519SigningContext,
+}
+
+VERIFYING_CONTEXTS = {
+    SignatureScheme.RSA: rsa_signing.VerifyingContext,
+    SignatureScheme.ED25519: Ed25519VerifyingContext,
+}
+
+PRIVATE_KEY_REGISTRIES = {
+    SignatureScheme.RSA: "RSA_PRIVATE_REGISTRY",
+    SignatureScheme.ED25519: "ED25519_PRIVATE_REGISTRY",
+}
+
+
+def get_scheme():
+    # The scheme all messages and updates are signed with, set by settings.SIGNATURE_SCHEME
+    return SignatureScheme[settings.SIGNATURE_SCHEME.upper()]
+
+
+def get_private_key_registry():
+    return getattr(settings, PRIVATE_KEY_REGISTRIES[get_scheme()])
+
+
+def generate_ed25519_keys():
+    # Returns the private key (seed) and the public key, as hex strings
+    key = ECC.generate(curve="Ed25519")
+    return key.seed.hex(), key.public_key().export_key(format="raw").hex()
+
+
+def sign(data):
+    return SIGNING_CONTEXTS[get_scheme()].from_registry().sign(data)
+
+
+def sign_hash(hash_object):
+    return SIGNING_CONTEXTS[get_scheme()].from_registry().sign_hash(hash_object)
+
+
+def validate(data, signature):
+    return VERIFYING_CONTEXTS[get_scheme()].from_registry().validate(data, signature)
+
+
+def validate_hash(hash_object, signature):
+    return VERIFYING_CONTEXTS[get_scheme()].from_registry().validate_hash(hash_object, signature)
@@ -0,0 +1,111 @@
+import os
+import errno
+import struct
+import shutil
+import zipfile
+
+
+def get_staging_path(update_path):
+    return f"{update_path}.staging"
+
+
+def remove_staging(staging_path):
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def get_central_directory_offset(update_file, size):
+    # Finds the end record of the zip (it is followed by a comment of up to 64KB) and returns the offset of the
+    # central directory, or None if the zip is not a plain (non zip64) zip
+    tail_size = min(size, zipfile.sizeEndCentDir + 0xFFFF)
+    update_file.seek(size - tail_size)
+    tail = update_file.read(tail_size)
+
+    position = tail.rfind(zipfile.stringEndArchive)
+    if position < 0 or position + zipfile.sizeEndCentDir > len(tail):
+        return None
+    _, _, _, _, _, _, offset, _ = struct.unpack(zipfile.structEndArchive,
+                                                tail[position:position + zipfile.sizeEndCentDir])
+    if offset == 0xFFFFFFFF or offset > size:
+        return None
+    return offset
+
+
+class Stager(object):
+    # Extracts the members of a (full) update into a staging folder while the update is downloaded.
+    # A member is extracted once all the chunks it spans were received and verified with the manifest,
+    # so only authentic bytes are staged. The central directory is at the end of the zip, so it is needed first.
+    def __init__(self, update_filepath, update_manifest, staging_path):
+        self.update_filepath = update_filepath
+        self.update_manifest = update_manifest
+        self.staging_path = staging_path
+        self.zip_handler = None
+        self.members = None  # (member, chunks it spans) of the members that were not staged yet
+
+    def get_chunks(self, offset, end):
+        # The chunks that hold the bytes offset..end (exclusive)
+        if end <= offset:
+            return range(0)
+        chunk_size = self.update_manifest.chunk_size
+        return range(offset // chunk_size, (end - 1) // chunk_size + 1)
+
+    def open(self, completed_chunks):
+        # Returns False if the chunks of the central directory were not received yet
+        size = self.update_manifest.size
+        tail_offset = max(size - zipfile.sizeEndCentDir - 0xFFFF, 0)
+        if not completed_chunks.issuperset(self.get_chunks(tail_offset, size)):
+            return False
+
+        with open(self.update_filepath, "rb") as update_file:
+            directory_offset = get_central_directory_offset(update_file, size)
+        if directory_offset is None:
+            raise zipfile.BadZipFile("The update has no central directory that can be staged")
+        if not completed_chunks.issuperset(self.get_chunks(directory_offset, size)):
+            return False
+
+        self.zip_handler = zipfile.ZipFile(self.update_filepath, "r")
+        members = sorted(self.zip_handler.infolist(), key=lambda member: member.header_offset)
+
+        # A member ends where the next one (or the central directory) starts
+        ends = [member.header_offset for member in members[1:]] + [directory_offset]
+        self.members = [(member, self.get_chunks(member.header_offset, end)) for member, end in zip(members, ends)]
+        return True
+
+    def stage(self, completed_chunks):
+        # Extracts the members whose chunks were completed, returns the number of members that were extracted
+        if self.zip_handler is None and not self.open(completed_chunks):
+            return 0
+
+        remaining_members = []
+        for member, chunks in self.members:
+            if completed_chunks.issuperset(chunks):
+                self.zip_handler.extract(member, path=self.staging_path)
+            else:
+                remaining_members.append((member, chunks))
+
+        staged_count = len(self.members) - len(remaining_members)
+        self.members = remaining_members
+        return staged_count
+
+    def is_staged(self):
+        return self.members is not None and len(self.members) == 0
+
+    def close(self):
+        if self.zip_handler is not None:
+            self.zip_handler.close()
+            self.zip_handler = None
+
+
+def activate_file(staging_path, relative_path, program_path):
+    # Moves a staged file into the program folder (a rename, when both are on the same volume).
+    # Returns the path of the file in the program folder.
+    source = os.path.join(staging_path, relative_path)
+    target = os.path.join(program_path, relative_path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The folders are on different volumes
+        shutil.move(source, target)
+    return target
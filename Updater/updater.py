@@ -3,47 +3,193 @@ import os
 import logging
 import socket
 import construct
-import zlib
-import threading
+import asyncio
+import collections
 import ipaddress
-
-import netifaces
+import struct
 
 from Updater import messages
-from Updater.messages import MessageType
-from Updater import rsa_signing
+from Updater.messages import MessageType, VersionContent
+from Updater import signing
 from Updater import settings
 from Updater import registry
+from Updater import manifest
+from Updater import journal
+from Updater import scheduler
+from Updater import duplicates
+from Updater import gossip
+from Updater import fec
+from Updater import interfaces
+from Updater import staging
 
 
-def get_all_broadcast_address(sender=None):
-    broadcasts = []
+def is_ipv4_address(address):
+    # Peers are reached through the IPv4 management socket only
+    return ipaddress.ip_address(address).version == 4
 
-    for interface in netifaces.interfaces():
-        interface = netifaces.ifaddresses(interface)
-        if netifaces.AF_INET not in interface:
-            continue
 
-        for address in interface[netifaces.AF_INET]:
-            if "addr" not in address or "netmask" not in address:
-                continue
+def get_multicast_groups(version):
+    return [group for group in settings.MULTICAST_GROUPS if ipaddress.ip_address(group).version == version]
 
-            interface_network = ipaddress.ip_interface(address["addr"] + "/" + address["netmask"]).network
-            if interface_network.is_loopback:
-                # We skip loop-back interfaces
-                continue
 
-            if sender:
-                # If sender is given, exclude it from the broadcasting list
-                sender_address = ipaddress.ip_address(sender)
-                if sender_address in interface_network:
-                    # We skip this network since our sender already sent a broadcast to it
-                    continue
+def join_multicast_groups(management_socket, groups):
+    # Joins the groups on every interface, so announcements are received on all of them
+    for group in groups:
+        if ipaddress.ip_address(group).version == 4:
+            memberships = [(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + socket.inet_aton(address))
+                           for address in interfaces.get_addresses()]
+        else:
+            memberships = [(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP,
+                            socket.inet_pton(socket.AF_INET6, group) + struct.pack("@I", index))
+                           for index in interfaces.get_ipv6_indices()]
+
+        for level, option, membership in memberships:
+            try:
+                management_socket.setsockopt(level, option, membership)
+            except socket.error as e:
+                # The interface might not support multicast
+                logging.info(f"Failed to join multicast group {group} on an interface: {e}")
+
+
+def hash_file(filepath):
+    hash_object = settings.HASH_MODULE()
+    with open(filepath, "rb") as file:
+        chunk = file.read(settings.VERSION_CHUNK_SIZE)
+        while len(chunk) != 0:
+            hash_object.update(chunk)
+            chunk = file.read(settings.VERSION_CHUNK_SIZE)
+    return hash_object
+
+
+def get_delta_fields(version):
+    # Returns the fields of VERSION_UPDATE message that advertise the delta of the given version
+    delta_fields = dict(delta_major=0, delta_minor=0, delta_size=0, delta_signature=0)
+
+    delta_registry = version.get_delta_registry_path()
+    if not registry.exists(delta_registry):
+        return delta_fields
+
+    delta_path = registry.get_value(delta_registry)
+    if not os.path.exists(delta_path):
+        logging.warning(f"Delta file of version {version} is missing: {delta_path}")
+        return delta_fields
+
+    base_major, base_minor = registry.get_value(version.get_delta_base_registry_path()).split(".")
+    delta_fields.update(
+        delta_major=int(base_major),
+        delta_minor=int(base_minor),
+        delta_size=os.stat(delta_path).st_size,
+        delta_signature=get_update_signature(delta_path),
+    )
+    return delta_fields
+
+
+def get_update_signature(update_path):
+    # The manifest that was created with the update keeps its signature, the update is only hashed and signed
+    # if it has no manifest (it was created before manifests kept the signature) or the manifest is outdated
+    try:
+        update_manifest = manifest.Manifest.load(manifest.get_manifest_path(update_path))
+        if update_manifest.size == os.stat(update_path).st_size:
+            update_signature = update_manifest.get_update_signature()
+            if update_signature is not None:
+                return update_signature
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    logging.info(f"Hashing {update_path}, its manifest has no signature of the update")
+    return signing.sign_hash(hash_file(update_path))
+
+
+def get_update_fields(version):
+    # Returns the fields of VERSION_UPDATE message that describe the update (and delta) of the given version.
+    # The signatures are read from the manifests, unless the update has to be hashed.
+    update_path = registry.get_value(version.get_update_registry_path())
+    update_fields = dict(
+        size=os.stat(update_path).st_size,
+        update_signature=get_update_signature(update_path),
+    )
+    update_fields.update(get_delta_fields(version))
+    return update_fields
+
+
+def build_version_update_message(version, spread, update_fields):
+    version_update_dict = dict(
+        type=MessageType.VERSION_UPDATE,
+        header_signature=0,
+        major=version.major,
+        minor=version.minor,
+        spread=spread
+    )
+    version_update_dict.update(update_fields)
+    return messages.build_message(messages.VERSION_UPDATE_MESSAGE, version_update_dict)
+
+
+class AnnouncementCache(object):
+    # Keeps the signed VERSION_UPDATE messages, so announcing a version doesn't hash and sign its update again.
+    # An entry is used as long as the update and delta files keep their size and modification time.
+    def __init__(self):
+        self.update_fields = dict()  # by version: (stamp, fields)
+        self.messages = dict()  # by (version, spread): (stamp, message)
+
+    @staticmethod
+    def get_stamp(version):
+        stamp = []
+        for version_registry in [version.get_update_registry_path(), version.get_delta_registry_path()]:
+            try:
+                file_stat = os.stat(registry.get_value(version_registry))
+                stamp.append((file_stat.st_size, file_stat.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def lookup(self, version, spread):
+        # Returns the cached message, or None if it needs to be built
+        entry = self.messages.get((str(version), spread))
+        if entry is not None and entry[0] == AnnouncementCache.get_stamp(version):
+            return entry[1]
+        return None
+
+    def get(self, version, spread):
+        message = self.lookup(version, spread)
+        if message is not None:
+            return message
+
+        # The stamp is taken before hashing, so a file that changes meanwhile is hashed again next time
+        stamp = AnnouncementCache.get_stamp(version)
+        entry = self.update_fields.get(str(version))
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, get_update_fields(version))
+            self.update_fields[str(version)] = entry
+
+        message = build_version_update_message(version, spread, entry[1])
+        self.messages[(str(version), spread)] = (stamp, message)
+        return message
+
+
+def get_chunk_runs(chunks):
+    # Groups chunk indices into runs of consecutive chunks, so each run is requested as a single range
+    runs = []
+    for index in sorted(chunks):
+        if runs and runs[-1][1] == index - 1:
+            runs[-1][1] = index
+        else:
+            runs.append([index, index])
+    return runs
+
+
+def get_update_server():
+    # Returns the address of the update server, or None if it can't be resolved
+    try:
+        return socket.gethostbyname(registry.get_value(settings.UPDATING_SERVER_REGISTRY))
+    except socket.error:
+        logging.info("Failed to resolve the address of the update server")
+        return None
 
-            broadcast = interface_network.broadcast_address.compressed
-            broadcasts.append(broadcast)
 
-    return broadcasts
+def read_chunk(file, offset, length):
+    file.seek(offset)
+    return file.read(length)
 
 
 def send_broadcast(message, sender=None):
@@ -56,7 +202,7 @@ def send_broadcast(message, sender=None):
         broadcaster.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
         # Sends the broadcast
-        for broadcast_address in get_all_broadcast_address(sender):
+        for broadcast_address in interfaces.get_broadcast_addresses(sender):
             logging.info(f"Sending broadcast to {broadcast_address}")
             broadcaster.sendto(message, (broadcast_address, port))
 
@@ -66,11 +212,72 @@ def send_broadcast(message, sender=None):
         broadcaster.close()
 
 
+def send_unicast(message, peers):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    port = registry.get_value(settings.PORT_REGISTRY)
+
+    try:
+        for peer in peers:
+            logging.info(f"Sending message to {peer}")
+            sender.sendto(message, (peer, port))
+    except socket.error:
+        logging.error("Unknown error while sending message :(", exc_info=True)
+    finally:
+        sender.close()
+
+
+def send_multicast(message):
+    port = registry.get_value(settings.PORT_REGISTRY)
+
+    for group in settings.MULTICAST_GROUPS:
+        if ipaddress.ip_address(group).version == 4:
+            family, level, hops_option, interface_option = (socket.AF_INET, socket.IPPROTO_IP,
+                                                            socket.IP_MULTICAST_TTL, socket.IP_MULTICAST_IF)
+            sending_interfaces = [socket.inet_aton(address) for address in interfaces.get_addresses()]
+        else:
+            family, level, hops_option, interface_option = (socket.AF_INET6, socket.IPPROTO_IPV6,
+                                                            socket.IPV6_MULTICAST_HOPS, socket.IPV6_MULTICAST_IF)
+            sending_interfaces = interfaces.get_ipv6_indices()
+
+        sender = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sender.setsockopt(level, hops_option, settings.MULTICAST_TTL)
+
+            # Sends the announcement once on every interface
+            for interface in sending_interfaces:
+                try:
+                    sender.setsockopt(level, interface_option, interface)
+                    sender.sendto(message, (group, port))
+                except socket.error as e:
+                    logging.info(f"Failed to send multicast to {group} on an interface: {e}")
+            logging.info(f"Sent multicast to {group}")
+        except socket.error:
+            logging.error("Unknown error while sending multicast :(", exc_info=True)
+        finally:
+            sender.close()
+
+
+def send_announcement(message):
+    # Sends a new announcement of the update server
+    send_broadcast(message)
+    if len(settings.MULTICAST_GROUPS) != 0:
+        # Multicast routers deliver the announcement to the other segments as well
+        send_multicast(message)
+    if settings.PROPAGATION == "gossip":
+        # Broadcasts don't cross routers, the seeds start the gossip in the other networks
+        send_unicast(message, settings.GOSSIP_PEERS)
+
+
 class Version(object):
     def __init__(self, major, minor):
         self.major = major
         self.minor = minor
 
+    @staticmethod
+    def from_string(version):
+        major, minor = version.split(".")
+        return Version(int(major), int(minor))
+
     @staticmethod
     def get_current_version():
         major = registry.get_value(settings.UPDATE_MAJOR_REGISTRY)
@@ -78,12 +285,27 @@ class Version(object):
         return Version(major, minor)
 
     def update_current_version(self):
-        registry.set_value(settings.UPDATE_MAJOR_REGISTRY, self.major)
-        registry.set_value(settings.UPDATE_MINOR_REGISTRY, self.minor)
+        with registry.batch():
+            registry.set_value(settings.UPDATE_MAJOR_REGISTRY, self.major)
+            registry.set_value(settings.UPDATE_MINOR_REGISTRY, self.minor)
 
     def get_update_registry_path(self):
         return settings.UPDATE_REGISTRY_FORMAT.format(self)
 
+    def get_delta_registry_path(self):
+        return settings.DELTA_REGISTRY_FORMAT.format(self)
+
+    def get_delta_base_registry_path(self):
+        return f"{self.get_delta_registry_path()}_base"
+
+    def get_staging_registry_path(self):
+        return settings.STAGING_REGISTRY_FORMAT.format(self)
+
+    def get_content_registry_path(self, content):
+        if int(content) == VersionContent.DELTA:
+            return self.get_delta_registry_path()
+        return self.get_update_registry_path()
+
     @staticmethod
     def get_installed_version():
         major = registry.get_value(settings.VERSION_MAJOR_REGISTRY)
@@ -91,8 +313,9 @@ class Version(object):
         return Version(major, minor)
 
     def update_installed_version(self):
-        registry.set_value(settings.VERSION_MAJOR_REGISTRY, self.major)
-        registry.set_value(settings.VERSION_MINOR_REGISTRY, self.minor)
+        with registry.batch():
+            registry.set_value(settings.VERSION_MAJOR_REGISTRY, self.major)
+            registry.set_value(settings.VERSION_MINOR_REGISTRY, self.minor)
 
     @staticmethod
     def is_updated():
@@ -126,19 +349,117 @@ class Version(object):
         return f"{self.major}.{self.minor}"
 
 
+class PeerBusyError(Exception):
+    # The peer answered a request with a BUSY message
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class PeerMissingError(Exception):
+    # The peer answered a request with a NOT_FOUND message
+    pass
+
+
+class ManagementProtocol(asyncio.DatagramProtocol):
+    # Receives the messages of the management socket on the event loop, and hands them to the updater
+    def __init__(self, updater, announcements_only=False):
+        self.updater = updater
+        self.announcements_only = announcements_only
+
+    def datagram_received(self, data, addr):
+        if messages.get_scheme(data) != messages.SCHEME:
+            logging.info(f"Received message of another signature scheme: received {messages.get_scheme(data)} "
+                         f"expected {messages.SCHEME}")
+            return
+
+        if len(data) != settings.MESSAGE_SIZE:
+            logging.info(f"Received message with incorrect size: received {len(data)} expected {settings.MESSAGE_SIZE}")
+            return
+
+        if self.announcements_only and messages.get_type(data) not in messages.SIGNED_MESSAGES:
+            # Requests are answered through the management socket only
+            logging.info(f"Received a message of type {messages.get_type(data)} on the multicast socket")
+            return
+
+        self.updater.message = data
+        self.updater.sender = addr
+        try:
+            self.updater.handle_message()
+        except Exception:
+            # A single bad message should never stop the service
+            logging.exception(f"Failed to handle message from {addr[0]}")
+
+    def error_received(self, exc):
+        logging.info(f"Failed to receive message on management socket: {exc}")
+
+
+class TransferProtocol(asyncio.DatagramProtocol):
+    # Receives the packets of a multicast transfer, and hands them to the decoder
+    def __init__(self, decoder, download_journal, loop):
+        self.decoder = decoder
+        self.download_journal = download_journal
+        self.loop = loop
+        self.last_packet_time = loop.time()
+        self.finished = loop.create_future()  # Done once all the missing chunks were received
+
+    def datagram_received(self, data, addr):
+        self.last_packet_time = self.loop.time()
+        completed_chunks = self.decoder.receive(data)
+        if len(completed_chunks) != 0:
+            self.download_journal.mark_completed(completed_chunks)
+            self.download_journal.save()
+        if len(self.decoder.missing_chunks) == 0 and not self.finished.done():
+            self.finished.set_result(True)
+
+    def error_received(self, exc):
+        logging.info(f"Failed to receive packet of multicast transfer: {exc}")
+
+
+class TransferSession(object):
+    # A version that is streamed to the multicast transfer group. The stream loops over the chunks, until a whole
+    # pass was streamed since the last request, so a receiver that joins in the middle gets the chunks it missed.
+    def __init__(self):
+        self.streamed = 0  # Number of chunks streamed so far
+        self.last_request = 0  # Number of chunks that were streamed when the last request arrived
+
+    def request(self):
+        self.last_request = self.streamed
+
+
 class Updater(object):
     def __init__(self):
         self.message = None
         self.sender = None
         self.management_socket = None
+        self.transport = None
+        self.multicast_socket = None  # Receives IPv6 multicast announcements (IPv4 ones arrive at the management socket)
+        self.multicast_transport = None
+        self.loop = None
+        self.stop_event = None
+        self.stop_requested = False
+        self.tasks = set()
+        self.upload_scheduler = scheduler.UploadScheduler(self.spawn, settings.UPLOAD_SLOTS, settings.UPLOAD_QUEUE_SIZE,
+                                                          settings.UPLOAD_QUEUE_TIMEOUT)
+        self.pending_requests = dict()  # Connections awaited from peers, by (peer, listening port)
+        self.announcements = AnnouncementCache()
+        self.received = duplicates.DuplicateFilter(settings.DUPLICATES_CACHE_SIZE, settings.DUPLICATES_TTL)
+        self.spread = duplicates.DuplicateFilter(settings.DUPLICATES_CACHE_SIZE, settings.DUPLICATES_TTL)
+        self.peers = gossip.PeerList(settings.GOSSIP_PEERS, settings.GOSSIP_MAX_PEERS)
+        self.download_queue = None
+        self.pending_downloads = dict()  # Announcements waiting for the download worker, by version
+        self.downloading_version = None
+        self.download_task = None
+        self.seeders = dict()  # Peers that announced a version, by version
+        self.transfers = dict()  # Multicast transfers being streamed, by (version, content)
         self.setup_listener()
 
     @staticmethod
     def is_server():
         # The updater can be run as an official updates server
         # An update server is distinguished from a normal client only by the
-        # fact that it knows the private RSA key
-        return registry.exists(settings.RSA_PRIVATE_REGISTRY)
+        # fact that it knows the private key
+        return registry.exists(signing.get_private_key_registry())
 
     def setup_listener(self):
         port = registry.get_value(settings.PORT_REGISTRY)
@@ -149,24 +470,124 @@ class Updater(object):
             logging.critical(f"Failed to bind service socket to port {port}.", exc_info=True)
             raise e
 
-    def broadcast_message(self):
-        sender = self.sender[0] if self.sender else None
-        send_broadcast(self.message, sender=sender)
+    async def start_listener(self):
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: ManagementProtocol(self),
+                                                                     sock=self.management_socket)
+        if len(settings.MULTICAST_GROUPS) != 0:
+            await self.start_multicast_listener()
 
-    def receive_message(self):
-        try:
-            message, sender = self.management_socket.recvfrom(settings.MESSAGE_SIZE)
+    async def start_multicast_listener(self):
+        join_multicast_groups(self.management_socket, get_multicast_groups(4))
 
-            if len(message) != settings.MESSAGE_SIZE:
-                logging.info(
-                    f"Received message with incorrect size: received {len(message)} expected {settings.MESSAGE_SIZE}")
-                message = sender = None
+        ipv6_groups = get_multicast_groups(6)
+        if len(ipv6_groups) == 0:
+            return
+
+        port = registry.get_value(settings.PORT_REGISTRY)
+        try:
+            self.multicast_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            self.multicast_socket.bind(("::", port))
         except socket.error:
-            logging.info("Failed to receive message on management socket. The message is probably too long.")
-            message = sender = None
+            logging.error(f"Failed to bind IPv6 multicast socket to port {port}.", exc_info=True)
+            self.multicast_socket.close()
+            self.multicast_socket = None
+            return
+
+        join_multicast_groups(self.multicast_socket, ipv6_groups)
+        self.multicast_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ManagementProtocol(self, announcements_only=True), sock=self.multicast_socket)
+
+    async def restart_listener(self):
+        self.cleanup_listener()
+        await asyncio.sleep(0)  # The transport closes the socket on the next iteration of the loop
+        self.setup_listener()
+        await self.start_listener()
+
+    def run(self):
+        # Runs the updater until stop() is called (can be called from another thread)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.stop_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        if self.stop_requested:
+            # stop() was called before the loop started
+            self.stop_event.set()
+        self.download_queue = asyncio.Queue()
+
+        # Registry values are read on every message, keep them in memory while the service runs
+        if not registry.watch(settings.REGISTRY_PATH):
+            logging.warning("Failed to watch the registry, values will not be cached")
+        # The interfaces are read on every broadcast, keep them until an address changes
+        if not interfaces.watch():
+            logging.info("Failed to watch the addresses of the interfaces, they are refreshed periodically")
+
+        await self.start_listener()
+        self.spawn(self.download_worker())
+        if settings.PROPAGATION == "gossip":
+            self.spawn(self.exchange_worker())
+
+        # Continues downloads that were interrupted when the service stopped
+        self.resume_downloads()
+
+        if Updater.is_server():
+            # Prepares the announcement of the current version, so the first request is answered right away
+            self.spawn(self.prepare_announcement())
+
+        logging.info("Waiting for packets...")
+        try:
+            await self.stop_event.wait()
+        finally:
+            # Also when the loop is interrupted (Ctrl+C, when running as a plain process)
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.cleanup_listener()
+            interfaces.unwatch()
+            registry.unwatch()
+
+    async def prepare_announcement(self):
+        current_version = Version.get_current_version()
+        if not registry.exists(current_version.get_update_registry_path()):
+            return
+        try:
+            await self.loop.run_in_executor(None, self.announcements.get, current_version, False)
+        except (OSError, construct.ConstructError):
+            logging.error(f"Failed to prepare the announcement of version {current_version}", exc_info=True)
+
+    def stop(self):
+        self.stop_requested = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def spawn(self, coroutine):
+        # Runs the coroutine in the background, keeping a reference so it isn't garbage collected
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def broadcast_message(self, message=None, sender=None):
+        message = message if message is not None else self.message
+        sender = sender if sender is not None else self.sender
+        sender = sender[0] if sender else None
+        if self.spread.check(message):
+            # Every announcement is spread once, even if it was handled again meanwhile
+            logging.info("Message was already spread")
+            return
+
+        # Our own broadcast might come back to us (through another interface), no need to verify it
+        self.received.remember(message)
 
-        self.message = message
-        self.sender = sender
+        if settings.PROPAGATION == "gossip":
+            # Forwards the message to a few random peers, every peer that accepts it does the same
+            port = registry.get_value(settings.PORT_REGISTRY)
+            for peer in self.peers.sample(settings.GOSSIP_FANOUT, exclude=[sender]):
+                self.transport.sendto(message, (peer, port))
+            return
+
+        send_broadcast(message, sender=sender)
 
     def handle_message(self):
         if len(self.message) != settings.MESSAGE_SIZE:
@@ -174,58 +595,177 @@ class Updater(object):
             logging.error(f"Received an invalid message length: {len(self.message)}")
             return
 
-        # Parse the message
+        message_type = messages.get_type(self.message)
+        if message_type not in messages.MESSAGE_FORMATS:
+            # Invalid message type, ignoring...
+            logging.warning(f"Received an invalid message type {message_type}")
+            return
+
+        is_duplicate = message_type in messages.SIGNED_MESSAGES and self.received.contains(self.message)
+
+        # Parse the message (once, the handlers get the parsed message)
         try:
-            message = messages.GENERIC_MESSAGE.parse(self.message)
+            message = messages.parse_message(self.message)
         except construct.ConstructError:
-            logging.error(f"Failed to parse message with length: {len(self.message)}", exc_info=True)
+            logging.error(f"Failed to parse message of type {message_type}: {self.message.hex()}", exc_info=True)
             return
 
-        if len(MessageType) < int(message.type):
-            # Invalid message type, ignoring...
-            logging.warning(f"Received an invalid message type {message.type}")
+        if is_duplicate:
+            # A copy of an announcement that was already validated and handled (spread by another peer, or
+            # received on another interface), dropped before the expensive signature validation.
+            # Its sender has the announced version though, so it can serve a part of it.
+            if message_type == MessageType.VERSION_UPDATE:
+                self.handle_duplicate_version_update(message)
+            logging.debug(f"Dropped a duplicate message of type {message_type}")
             return
 
-        message_type = int(message.type)
+        seal = messages.get_seal(self.message)
         # These messages don't require authentication (they are created by the clients)
         # In these messages the 'signature' is nothing but a CRC32 checksum
-        if message_type in [MessageType.REQUEST_VERSION, MessageType.REQUEST_UPDATE]:
+        if message_type not in messages.SIGNED_MESSAGES:
             calculated_checksum = messages.calculate_crc(self.message)
-            if calculated_checksum != message.signature:
+            if calculated_checksum != seal:
                 # Invalid checksum, ignore message...
-                logging.info(f"Received a message with incorrect checksum. received {hex(message.signature)} expected {hex(calculated_checksum)}.")
+                logging.info(f"Received a message with incorrect checksum. received {hex(seal)} expected {hex(calculated_checksum)}.")
                 return
 
+            # The sender is not remembered as a peer to gossip with, anyone can send these messages
+            # (except for an exchange of peers, which is how nodes join the gossip)
+
             if message_type == MessageType.REQUEST_VERSION:
-                update_sender = threading.Thread(target=Updater.send_version_update, args=(self.message, self.sender))
-                update_sender.setDaemon(True)
-                logging.info(f"Sending update on another thread to {self.sender[0]}")
-                update_sender.start()
+                self.handle_request_version(message)
+            elif message_type == MessageType.BUSY:
+                self.handle_busy(message)
+            elif message_type == MessageType.NOT_FOUND:
+                self.handle_not_found(message)
+            elif message_type == MessageType.PEERS:
+                self.handle_peers(message)
             elif message_type == MessageType.REQUEST_UPDATE:
                 if Updater.is_server():
                     # Only the server answers to MessageType.REQUEST_UPDATE
-                    self.handle_request_update()
+                    self.spawn(self.handle_request_update(self.sender))
                 else:
                     logging.info("A client requested a version from this non-server service.")
 
             return
 
         # Validates the message signature
-        if not rsa_signing.validate(str(int(message.type)).encode('ascii') + message.data, message.signature):
+        if not signing.validate(messages.get_sealed_data(self.message), seal):
             # Could be either an error in the message or an attacker tampered message
-            logging.warning(f"Invalid signature detected: {hex(message.signature)} (maybe tampered?)")
+            logging.warning(f"Invalid signature detected: {hex(seal)} (maybe tampered?)")
             return
+        self.received.remember(self.message)
+
+        # The sender runs the updater too (it spread a signed announcement), remember it as a peer to gossip with
+        if is_ipv4_address(self.sender[0]):
+            self.peers.add(self.sender[0])
 
         # Handle message
         if message_type == MessageType.SERVER_UPDATE:
-            self.handle_server_update()
+            self.handle_server_update(message)
         elif message_type == MessageType.VERSION_UPDATE:
-            self.handle_version_update()
+            self.handle_version_update(message)
         else:
             # Unimplemented message type, probably an error...
             logging.error(f"Received an unimplemented message type {message_type}")
 
-    def handle_request_update(self):
+    def handle_request_version(self, message):
+        requester = self.sender
+        if message.multicast:
+            self.request_transfer(message)
+            return
+
+        # Manifests take upload slots as well, they hold the hashes of every chunk and file of the update
+        if self.upload_scheduler.request(requester[0], lambda: self.send_version_update(message, requester),
+                                         lambda: self.send_busy(requester, message.listening_port)):
+            logging.info(f"Scheduled upload of version {message.major}.{message.minor} to {requester[0]}")
+            return
+
+        # All the upload slots are taken and the queue is full
+        self.send_busy(requester, message.listening_port)
+
+    def send_busy(self, requester, listening_port):
+        # Tells the requester to try later, instead of waiting for a connection that won't come in time
+        logging.info(f"Too many uploads, {requester[0]} should try again later")
+        busy_dict = dict(
+            type=MessageType.BUSY,
+            crc32=0,
+            listening_port=listening_port,
+            retry_after=settings.UPLOAD_RETRY_AFTER
+        )
+        self.send_reply(requester, messages.BUSY_MESSAGE, busy_dict)
+
+    def send_not_found(self, requester, listening_port):
+        # Tells the requester to ask another peer, instead of waiting for a connection that will never come
+        not_found_dict = dict(
+            type=MessageType.NOT_FOUND,
+            crc32=0,
+            listening_port=listening_port
+        )
+        self.send_reply(requester, messages.NOT_FOUND_MESSAGE, not_found_dict)
+
+    def send_reply(self, requester, message_format, reply_dict):
+        try:
+            reply_message = messages.build_message(message_format, reply_dict)
+        except construct.ConstructError:
+            # Should never occur
+            logging.critical(f"Failed to build reply message of type {reply_dict['type']}", exc_info=True)
+            return
+
+        self.transport.sendto(reply_message, (requester[0], registry.get_value(settings.PORT_REGISTRY)))
+
+    def handle_busy(self, message):
+        # Stops waiting for the connection of the rejected request.
+        # Anyone can send this message, so the wait it asks for is limited.
+        connected = self.pending_requests.get((self.sender[0], message.listening_port))
+        if connected is not None and not connected.done():
+            connected.set_exception(PeerBusyError(min(message.retry_after, settings.BUSY_MAX_WAIT)))
+
+    def handle_not_found(self, message):
+        # Stops waiting for the connection of the request the peer can't serve
+        connected = self.pending_requests.get((self.sender[0], message.listening_port))
+        if connected is not None and not connected.done():
+            connected.set_exception(PeerMissingError())
+
+    async def exchange_worker(self):
+        # Registers with the seeds, then exchanges peers with a random known peer periodically,
+        # so every node learns peers to gossip with besides the seeds (and the seeds learn every node)
+        for seed in self.peers.seeds:
+            if seed not in interfaces.get_addresses():
+                self.send_peers(seed, reply=False)
+
+        while True:
+            await asyncio.sleep(settings.GOSSIP_EXCHANGE_INTERVAL)
+            for peer in self.peers.sample(1, exclude=interfaces.get_addresses()):
+                self.send_peers(peer, reply=False)
+
+    def send_peers(self, peer, reply):
+        peers_dict = dict(
+            type=MessageType.PEERS,
+            crc32=0,
+            reply=reply,
+            peers=[socket.inet_aton(address)
+                   for address in self.peers.get_exchange(settings.GOSSIP_EXCHANGE_SIZE, peer)
+                   if is_ipv4_address(address)]
+        )
+        self.send_reply((peer,), messages.PEERS_MESSAGE, peers_dict)
+
+    def handle_peers(self, message):
+        if settings.PROPAGATION != "gossip" or not is_ipv4_address(self.sender[0]):
+            return
+
+        if not message.reply:
+            # Answers with some of our peers, the sender registered with us or picked us for an exchange
+            self.send_peers(self.sender[0], reply=True)
+
+        # Anyone can send this message, so it only adds a few unicast peers (the least recently heard ones are
+        # forgotten first)
+        peers = [ipaddress.ip_address(peer) for peer in message.peers[:settings.GOSSIP_EXCHANGE_SIZE]]
+        peers = [str(peer) for peer in peers if not (peer.is_multicast or peer.is_unspecified or peer.is_reserved)]
+        self.peers.merge_exchange(self.sender[0], peers, exclude=interfaces.get_addresses())
+        logging.debug(f"Exchanged peers with {self.sender[0]}, knows {len(self.peers.peers)} peers")
+
+    async def handle_request_update(self, requester):
         current_version = Version.get_current_version()
         update_path = registry.get_value(current_version.get_update_registry_path())
 
@@ -233,64 +773,26 @@ class Updater(object):
             logging.error("Update file does not exist! Updates will not be available.")
             return
 
-        # Sign the update file
-        hash_object = settings.HASH_MODULE()
-        update_size = os.stat(update_path).st_size
-        bytes_read = 0
-        with open(update_path, "rb") as update:
-            while bytes_read < update_size:
-                data = update.read(settings.VERSION_CHUNK_SIZE)
-                hash_object.update(data)
-                bytes_read += len(data)
-
-        version_update_dict = dict(
-            type=MessageType.VERSION_UPDATE,
-            header_signature=0,
-            major=current_version.major,
-            minor=current_version.minor,
-            size=update_size,
-            update_signature=rsa_signing.sign_hash(hash_object),
-            spread=False
-        )
+        # Only the first request of a version hashes and signs the update (off the event loop, so it keeps serving)
         try:
-            version_update_message = messages.VERSION_UPDATE_MESSAGE.build(version_update_dict)
-
-            # Update signature
-            version_update_dict["header_signature"] = messages.sign_message(version_update_message)
-            version_update_message = messages.VERSION_UPDATE_MESSAGE.build(version_update_dict)
+            version_update_message = self.announcements.lookup(current_version, False)
+            if version_update_message is None:
+                version_update_message = await self.loop.run_in_executor(None, self.announcements.get,
+                                                                         current_version, False)
         except construct.ConstructError:
             # Should never occur
             logging.critical(f"Failed to build version update message", exc_info=True)
             return
 
-        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sender.settimeout(settings.CONNECTION_TIMEOUT)
         port = registry.get_value(settings.PORT_REGISTRY)
-
         try:
             # Sends the message
-            sender.sendto(version_update_message, (self.sender[0], port))
-            logging.info(f"Sent version {current_version} to {self.sender[0]}.")
+            self.transport.sendto(version_update_message, (requester[0], port))
+            logging.info(f"Sent version {current_version} to {requester[0]}.")
         except socket.error:
             logging.error("Unknown error while sending update message :(", exc_info=True)
-        finally:
-            sender.shutdown(2)
-            sender.close()
-
-    def handle_server_update(self):
-        if len(self.message) != messages.SERVER_UPDATE_MESSAGE.sizeof():
-            # The message has an incorrect size...
-            logging.warning(f"Incorrect message size: {len(self.message)}")
-            return
-
-        # Parse the message
-        try:
-            message = messages.SERVER_UPDATE_MESSAGE.parse(self.message)
-        except construct.ConstructError:
-            # Should never occur
-            logging.critical(f"Failed to parse server update message: {self.message.hex()}", exc_info=True)
-            return
 
+    def handle_server_update(self, message):
         # Check the running id is more updated than the current id
         current_id = registry.get_value(settings.ADDRESS_ID_REGISTRY)
         if current_id >= message.address_id:
@@ -304,29 +806,16 @@ class Updater(object):
 
         # The message is updated, update our data!
         address = message.address.decode("ascii")
-        registry.set_value(settings.UPDATING_SERVER_REGISTRY, address)
-        registry.set_value(settings.PORT_REGISTRY, message.port)
-        registry.set_value(settings.ADDRESS_ID_REGISTRY, message.address_id)
+        with registry.batch():
+            registry.set_value(settings.UPDATING_SERVER_REGISTRY, address)
+            registry.set_value(settings.PORT_REGISTRY, message.port)
+            registry.set_value(settings.ADDRESS_ID_REGISTRY, message.address_id)
         logging.info(f"Updated address to {address} and port to {message.port}")
 
         # Since port could have changed, we restart our socket
-        self.cleanup_listener()
-        self.setup_listener()
-
-    def handle_version_update(self):
-        if len(self.message) != messages.VERSION_UPDATE_MESSAGE.sizeof():
-            # The message has an incorrect size...
-            logging.warning(f"Incorrect message size: {len(self.message)}")
-            return
-
-        # Parse the message
-        try:
-            message = messages.VERSION_UPDATE_MESSAGE.parse(self.message)
-        except construct.ConstructError:
-            # Should never occur
-            logging.critical(f"Failed to parse server update message: {self.message.hex()}", exc_info=True)
-            return
+        self.spawn(self.restart_listener())
 
+    def handle_version_update(self, message):
         # Check the version is not an outdated version
         update_version = Version(message.major, message.minor)
         current_version = Version.get_current_version()
@@ -335,89 +824,250 @@ class Updater(object):
             logging.info(f"Received an outdated version update message. current version: {current_version}, update version: {update_version}.")
             return
 
-        # The version contains an update! download it!
-        if self.download_update(message):
-            # Checks if the sender requested to spread this message using broadcast
-            if message.spread:
-                self.broadcast_message()
+        # The sender announces versions it already has, so it can serve a part of it
+        self.add_seeder(update_version, self.sender[0])
 
-    def download_update(self, message):
-        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # The version contains an update! queue it for the download worker, so the management socket keeps serving
+        self.queue_download(update_version, message)
 
-        try:
-            # Creates the TCP server that receives the update
-            listener.settimeout(settings.CONNECTION_TIMEOUT)
-            listener.bind(("0.0.0.0", 0))  # Bind to random port
-            port = listener.getsockname()[1]
-            listener.listen(1)
+    def handle_duplicate_version_update(self, message):
+        update_version = Version(message.major, message.minor)
+        if Version.get_current_version() >= update_version:
+            return
+        self.add_seeder(update_version, self.sender[0])
+
+        version = str(update_version)
+        if version != str(self.downloading_version) and version not in self.pending_downloads:
+            # The version was received before, but the launcher failed to apply its delta and asked for it again
+            self.queue_download(update_version, message)
+
+    def queue_download(self, update_version, message):
+        version = str(update_version)
+        if version == str(self.downloading_version) or version in self.pending_downloads:
+            # The same announcement was already received (probably from another peer that spread it)
+            logging.info(f"Version {version} is already being downloaded")
+            return
 
-            # Build the request version message
-            requested_version = Version(message.major, message.minor)
-            request_version_dict =  dict(
-                                        type=MessageType.REQUEST_VERSION,
-                                        crc32=0,
-                                        listening_port=port,
-                                        major=requested_version.major,
-                                        minor=requested_version.minor
-                                    )
+        if self.downloading_version is not None and update_version > self.downloading_version:
+            # A newer version makes the current download useless (its journal is kept anyway)
+            logging.info(f"Canceling download of version {self.downloading_version}, version {version} was announced")
+            self.download_task.cancel()
+
+        self.pending_downloads[version] = (message, self.message, self.sender)
+        self.download_queue.put_nowait(version)
+
+    async def download_worker(self):
+        # Downloads the queued versions one at a time
+        while True:
+            version = await self.download_queue.get()
+            message, announcement, announcer = self.pending_downloads.pop(version)
+
+            update_version = Version(message.major, message.minor)
+            if Version.get_current_version() >= update_version:
+                # An earlier download already got this version (or a newer one)
+                continue
+            if any(Version.from_string(pending) > update_version for pending in self.pending_downloads):
+                # A newer version is waiting in the queue
+                logging.info(f"Skipping download of version {version}, a newer version is queued")
+                continue
+
+            self.downloading_version = update_version
+            self.download_task = self.loop.create_task(self.download_update(message, announcement, announcer))
             try:
-                request_version_message = messages.REQUEST_VERSION_MESSAGE.build(request_version_dict)
+                succeeded = await self.download_task
+            except asyncio.CancelledError:
+                if self.stop_event.is_set():
+                    # The updater is stopping
+                    raise
+                # The download was canceled in favor of a newer version
+                succeeded = False
+            except Exception:
+                # A single broken download never stops the worker
+                logging.exception(f"Failed to download version {version}")
+                succeeded = False
+            finally:
+                self.downloading_version = None
+                self.download_task = None
+
+            if not succeeded:
+                # Lets the announcement be handled again, if it is received again
+                self.received.forget(announcement)
 
-                # Update CRC32
-                request_version_dict["crc32"] = messages.calculate_crc(request_version_message)
-                request_version_message = messages.REQUEST_VERSION_MESSAGE.build(request_version_dict)
-            except construct.ConstructError:
-                # Should never occur
-                logging.critical(f"Failed to build request update message", exc_info=True)
-                return False
+            # Checks if the sender requested to spread this message using broadcast
+            if succeeded and message.spread:
+                self.broadcast_message(announcement, announcer)
+
+    def resume_downloads(self):
+        # Continues the downloads that were interrupted, for example by a restart of the service
+        for journal_path in journal.get_all_journals():
+            download_journal = journal.DownloadJournal.load(journal_path)
+            if download_journal is None:
+                logging.info(f"Removing corrupted download journal {journal_path}")
+                os.remove(journal_path)
+                continue
 
-            # Creating the file for the update
-            update_filepath = settings.UPDATE_PATH
-            update_filepath = f"{update_filepath}.{requested_version}"
-            update_file = open(update_filepath, "wb")
+            if Version.from_string(download_journal.version) <= Version.get_current_version():
+                # A newer version was received since then, the partial download is useless
+                logging.info(f"Removing outdated partial download of version {download_journal.version}")
+                download_journal.delete()
+                update_path = journal.get_update_path(journal_path)
+                for path in [update_path, manifest.get_manifest_path(update_path)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                staging.remove_staging(staging.get_staging_path(update_path))
+                continue
 
-            # Request the update (so that the Updater will connect to our listening socket)
-            port = registry.get_value(settings.PORT_REGISTRY)
-            temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            temp_socket.sendto(request_version_message, 0, (self.sender[0], port))
-            temp_socket.shutdown(2)
-            temp_socket.close()
-
-            # Awaits for sender to connect
-            receiver, _ = listener.accept()
-            receiver.settimeout(settings.CONNECTION_TIMEOUT)
-            data_received = 0
-            hash_object = settings.HASH_MODULE()
-
-            # Download the update
-            logging.info(f"Downloading update of version {requested_version}")
-            with update_file:
-                while data_received < message.size:
-                    chunk = receiver.recv(settings.VERSION_CHUNK_SIZE)
-                    if len(chunk) == 0: # Occurs when the other side closed the conenction
-                        break
-                    update_file.write(chunk)
-                    hash_object.update(chunk)
-                    data_received += len(chunk)
+            # Handles the announcement again, as if it was just received from the peer that sent it
+            logging.info(f"Resuming interrupted download of version {download_journal.version}")
+            self.message = download_journal.announcement
+            self.sender = (download_journal.peer, registry.get_value(settings.PORT_REGISTRY))
+            self.handle_message()
+
+    def add_seeder(self, version, peer):
+        if not is_ipv4_address(peer):
+            return
+
+        seeders = self.seeders.setdefault(str(version), [])
+        if peer not in seeders:
+            seeders.append(peer)
+            del seeders[:-settings.SWARM_MAX_PEERS]
+
+    def get_seeders(self, version, announcer):
+        # The announcer of the version comes first, since it surely has the version
+        peers = [announcer[0]] if is_ipv4_address(announcer[0]) else []
+        peers += [peer for peer in self.seeders.get(str(version), []) if peer not in peers]
+
+        # The update server always holds the most updated version
+        server = get_update_server()
+        if server is not None and server not in peers:
+            peers.append(server)
 
-            # Close the TCP connection
-            receiver.shutdown(socket.SHUT_RD)
-            receiver.close()
+        return peers[:settings.SWARM_MAX_PEERS]
 
-            # Validate the update signature
-            if not rsa_signing.validate_hash(hash_object, message.update_signature):
+    async def download_update(self, message, announcement, announcer):
+        requested_version = Version(message.major, message.minor)
+
+        # Prefer the delta, if it patches the version that is installed on this computer
+        content = VersionContent.UPDATE
+        update_size = message.size
+        update_signature = message.update_signature
+        update_filepath = f"{settings.UPDATE_PATH}.{requested_version}"
+        version_registry = requested_version.get_update_registry_path()
+        # (unless the launcher failed to apply the delta of this version before)
+        skip_delta = registry.exists(settings.SKIP_DELTA_REGISTRY) and \
+            registry.get_value(settings.SKIP_DELTA_REGISTRY) == str(requested_version)
+        if message.delta_size != 0 and not skip_delta and \
+                Version(message.delta_major, message.delta_minor) == Version.get_installed_version():
+            content = VersionContent.DELTA
+            update_size = message.delta_size
+            update_signature = message.delta_signature
+            update_filepath = f"{update_filepath}.delta"
+            version_registry = requested_version.get_delta_registry_path()
+
+        peers = self.get_seeders(requested_version, announcer)
+        manifest_path = manifest.get_manifest_path(update_filepath)
+        staging_path = staging.get_staging_path(update_filepath)
+        download_journal = journal.DownloadJournal.load(journal.get_journal_path(update_filepath))
+        staging_task = None
+        try:
+            # Resume a previous download of the same update, if its journal and manifest were kept
+            update_manifest = None
+            if download_journal is not None and os.path.exists(update_filepath) and os.path.exists(manifest_path):
+                try:
+                    update_manifest = manifest.Manifest.load(manifest_path)
+                    if not update_manifest.is_valid(requested_version, update_size) or \
+                            not download_journal.matches(requested_version, content, update_size, update_signature,
+                                                         len(update_manifest.chunks)):
+                        update_manifest = None
+                except (OSError, ValueError, KeyError, TypeError):
+                    # A corrupted manifest, the download starts over
+                    logging.info(f"Invalid manifest for the partial download of version {requested_version}")
+                    update_manifest = None
+                if update_manifest is None:
+                    download_journal.delete()
+
+            if update_manifest is None:
+                # Download the signed manifest of the update, so every chunk can be verified as it arrives
+                for peer in peers:
+                    update_manifest = await self.download_manifest(peer, requested_version, content, update_size)
+                    if update_manifest is not None:
+                        break
+                if update_manifest is None:
+                    return False
+                update_manifest.save(manifest_path)
+
+                # Files that were staged by an earlier download might not be part of this update
+                staging.remove_staging(staging_path)
+
+                # Preallocate the update file, so every peer can write its chunks in place
+                with open(update_filepath, "wb") as update_file:
+                    update_file.truncate(update_size)
+
+                download_journal = journal.DownloadJournal(journal.get_journal_path(update_filepath), requested_version,
+                                                           content, update_size, update_signature,
+                                                           len(update_manifest.chunks), announcement, announcer[0])
+                download_journal.save()
+            else:
+                logging.info(f"Resuming download of version {requested_version}")
+
+            # Full updates are extracted while they are downloaded, so installing them only moves the staged files
+            download_finished = asyncio.Event()
+            if content == VersionContent.UPDATE:
+                stager = staging.Stager(update_filepath, update_manifest, staging_path)
+                staging_task = self.loop.create_task(self.stage_update(stager, download_journal, download_finished))
+
+            # Download the update, re-fetching only the chunks that failed verification
+            logging.info(f"Downloading {content.name.lower()} of version {requested_version} from {len(peers)} peers")
+            missing_chunks = set(range(len(update_manifest.chunks))) - download_journal.get_completed()
+            if settings.MULTICAST_TRANSFER_GROUP and len(missing_chunks) != 0:
+                # Most of the update is received from the stream of the update server, along with all the
+                # other receivers. The chunks that were lost on the way are downloaded from the peers.
+                await self.receive_transfer(requested_version, content, update_manifest, update_filepath,
+                                            missing_chunks, download_journal)
+            for attempt in range(settings.DOWNLOAD_ATTEMPTS):
+                await self.download_from_peers(peers, requested_version, content, update_manifest, update_filepath,
+                                               missing_chunks, download_journal)
+                if len(missing_chunks) == 0:
+                    break
+                logging.info(f"{len(missing_chunks)} chunks are missing or corrupted, retrying...")
+
+            if len(missing_chunks) != 0:
+                # The journal is kept, so the next attempt continues from here
+                logging.info(f"Failed to download version {requested_version}: {len(missing_chunks)} chunks are missing")
+                return False
+
+            # Validate the update signature (while the last members are staged).
+            # Every chunk matched the signed manifest, so the update is hashed only if the manifest has no hash of it.
+            download_journal.delete()
+            download_finished.set()
+            hash_object = update_manifest.get_update_hash()
+            if hash_object is None:
+                hash_object = await self.loop.run_in_executor(None, hash_file, update_filepath)
+            is_staged = staging_task is not None and await staging_task
+            if not signing.validate_hash(hash_object, update_signature):
                 # Delete this invalid update file
                 os.remove(update_filepath)
+                os.remove(manifest_path)
+                staging.remove_staging(staging_path)
                 logging.info("Invalid signature for update file (maybe tampered?)")
                 return False
 
             # Update the registry with the current update
-            version_registry = requested_version.get_update_registry_path()
-            registry.set_value(version_registry, os.path.abspath(update_filepath))
-            requested_version.update_current_version()
+            with registry.batch():
+                registry.set_value(version_registry, os.path.abspath(update_filepath))
+                if is_staged:
+                    # The launcher activates the staged files only once the signature was validated
+                    registry.set_value(requested_version.get_staging_registry_path(), os.path.abspath(staging_path))
+                if content == VersionContent.DELTA:
+                    base_version = Version(message.delta_major, message.delta_minor)
+                    registry.set_value(requested_version.get_delta_base_registry_path(), str(base_version))
+                elif skip_delta:
+                    registry.delete(settings.SKIP_DELTA_REGISTRY)
+                requested_version.update_current_version()
+            self.seeders.pop(str(requested_version), None)
             logging.info(f"Received new update: version {requested_version}")
 
-        except socket.timeout:
+        except asyncio.TimeoutError:
             # Connection was timed-out, too bad... abort
             logging.info("Connection timed out")
             return False
@@ -426,70 +1076,494 @@ class Updater(object):
             logging.info("Socket error has occurred")
             return False
         finally:
-            listener.close()
+            if staging_task is not None and not staging_task.done():
+                staging_task.cancel()
 
         return True
 
-    @staticmethod
-    def send_version_update(message, requester):
-        if len(message) != messages.REQUEST_VERSION_MESSAGE.sizeof():
-            # The message has an incorrect size...
-            logging.warning(f"Incorrect message size: {len(message)}")
-            return
+    async def stage_update(self, stager, download_journal, download_finished):
+        # Stages the members of the update as their chunks are received, and the rest once the download finished.
+        # Returns True if the whole update was staged.
+        try:
+            while not download_finished.is_set():
+                try:
+                    await asyncio.wait_for(download_finished.wait(), settings.STAGING_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                await self.loop.run_in_executor(None, stager.stage, download_journal.get_completed())
+        except Exception:
+            # Staging only saves time, the launcher extracts the update if it wasn't staged
+            logging.warning(f"Failed to stage update {stager.update_filepath}", exc_info=True)
+            stager.close()
+            return False
+
+        stager.close()
+        return stager.is_staged()
+
+    async def request_version(self, peer, version, content, is_manifest=False, offset=0, length=0):
+        # Requests a version from a peer and returns the connection the peer has sent it on
+        connected = self.loop.create_future()
+
+        def on_connection(reader, writer):
+            if connected.done():
+                # Only the first connection is expected
+                writer.close()
+                return
+            connected.set_result((reader, writer))
 
-        # Parse the message
+        # Creates the TCP server that receives the update
+        listener = await asyncio.start_server(on_connection, "0.0.0.0", 0)  # Bind to random port
         try:
-            message = messages.REQUEST_VERSION_MESSAGE.parse(message)
-        except construct.ConstructError:
-            # Should never occur
-            logging.critical(f"Failed to parse request update message: {message.hex()}", exc_info=True)
+            port = listener.sockets[0].getsockname()[1]
+
+            # Build the request version message
+            request_version_dict =  dict(
+                                        type=MessageType.REQUEST_VERSION,
+                                        crc32=0,
+                                        listening_port=port,
+                                        major=version.major,
+                                        minor=version.minor,
+                                        content=content,
+                                        manifest=is_manifest,
+                                        offset=offset,
+                                        length=length,
+                                        multicast=False
+                                    )
+            try:
+                request_version_message = messages.build_message(messages.REQUEST_VERSION_MESSAGE, request_version_dict)
+            except construct.ConstructError:
+                # Should never occur
+                logging.critical(f"Failed to build request update message", exc_info=True)
+                return None
+
+            # Request the update (so that the Updater will connect to our listening socket)
+            self.pending_requests[(peer, port)] = connected
+            self.transport.sendto(request_version_message, (peer, registry.get_value(settings.PORT_REGISTRY)))
+
+            # Awaits for sender to connect (or to answer that it is busy)
+            return await asyncio.wait_for(connected, settings.CONNECTION_TIMEOUT)
+        finally:
+            self.pending_requests.pop((peer, port), None)
+            listener.close()
+
+    async def download_manifest(self, peer, version, content, size):
+        try:
+            connection = await self.request_version(peer, version, content, is_manifest=True)
+        except (asyncio.TimeoutError, socket.error):
+            logging.info(f"Failed to request the manifest of version {version} from {peer}")
+            return None
+        except PeerBusyError:
+            # The manifest is requested from the next peer instead
+            logging.info(f"{peer} is too busy to send the manifest of version {version}")
+            return None
+        except PeerMissingError:
+            logging.info(f"{peer} doesn't have the manifest of version {version}")
+            return None
+        if connection is None:
+            return None
+
+        reader, writer = connection
+        max_size = manifest.Manifest.get_max_size(size)
+        data = bytearray()
+        try:
+            # The manifest is sent whole, read until the other side closes the connection (never more than max_size)
+            while not reader.at_eof():
+                data += await asyncio.wait_for(reader.read(max_size + 1 - len(data)), settings.CONNECTION_TIMEOUT)
+                if len(data) > max_size:
+                    logging.info(f"Manifest of version {version} from {peer} is too large")
+                    return None
+        except (asyncio.TimeoutError, socket.error):
+            logging.info(f"Failed to receive the manifest of version {version} from {peer}")
+            return None
+        finally:
+            writer.close()
+
+        try:
+            update_manifest = manifest.Manifest.loads(data)
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Received an invalid manifest for version {version}")
+            return None
+
+        if not update_manifest.is_valid(version, size):
+            logging.warning(f"Invalid signature for manifest of version {version} (maybe tampered?)")
+            return None
+
+        # The peer served a signed manifest over TCP, remember it as a peer to gossip with
+        self.peers.add(peer)
+        return update_manifest
+
+    async def download_from_peers(self, peers, version, content, update_manifest, update_filepath, missing_chunks,
+                                  download_journal):
+        # Splits the missing chunks into disjoint ranges, and downloads them from all the peers concurrently.
+        # Every peer takes the next range once it finished its current one, so faster peers serve more ranges.
+        ranges = collections.deque()
+        for first, last in get_chunk_runs(missing_chunks):
+            for range_first in range(first, last + 1, settings.SWARM_RANGE_CHUNKS):
+                ranges.append((range_first, min(range_first + settings.SWARM_RANGE_CHUNKS - 1, last)))
+        # The end of the update holds the central directory of the zip, which is needed to stage the update
+        ranges.rotate(1)
+
+        async def download_from_peer(peer):
+            failures = 0
+            busy_answers = 0
+            with open(update_filepath, "r+b") as update_file:
+                while failures < settings.SWARM_PEER_FAILURES and busy_answers < settings.SWARM_PEER_BUSY_RETRIES:
+                    if len(ranges) == 0:
+                        return
+                    first, last = ranges.popleft()
+
+                    try:
+                        received_chunks = await self.download_chunks(peer, version, content, update_manifest,
+                                                                      first, last, update_file)
+                    except PeerBusyError as e:
+                        # Let the other peers take the range, and ask this peer again later
+                        ranges.append((first, last))
+                        busy_answers += 1
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    except PeerMissingError:
+                        # The peer doesn't have this content (for example it holds only the delta of the version)
+                        ranges.append((first, last))
+                        logging.info(f"{peer} doesn't have {content.name.lower()} of version {version}")
+                        return
+                    missing_chunks.difference_update(received_chunks)
+                    if len(received_chunks) != 0:
+                        download_journal.mark_completed(received_chunks)
+                        download_journal.save()
+
+                    if len(received_chunks) != last - first + 1:
+                        # Give the rest of the range to the other peers
+                        failures += 1
+                        for run in get_chunk_runs(set(range(first, last + 1)) - set(received_chunks)):
+                            ranges.append(tuple(run))
+
+            logging.info(f"Stopped downloading from {peer} after {failures} failures and {busy_answers} busy answers")
+
+        await asyncio.gather(*[download_from_peer(peer) for peer in peers])
+
+    async def receive_transfer(self, version, content, update_manifest, update_filepath, missing_chunks,
+                               download_journal):
+        # Receives the missing chunks from the multicast transfer of the update server, until all of them were
+        # received or the stream stopped. Chunks that were lost (and could not be recovered) stay missing.
+        server = get_update_server()
+        if server is None:
             return
 
+        missing_count = len(missing_chunks)
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transport = None
+        try:
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # A large buffer absorbs the burst of a whole chunk, while the event loop is busy
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, settings.MANIFEST_CHUNK_SIZE * 4)
+            receiver.bind(("0.0.0.0", settings.MULTICAST_TRANSFER_PORT))
+            join_multicast_groups(receiver, [settings.MULTICAST_TRANSFER_GROUP])
+
+            request_version_dict = dict(
+                type=MessageType.REQUEST_VERSION,
+                crc32=0,
+                listening_port=0,
+                major=version.major,
+                minor=version.minor,
+                content=content,
+                manifest=False,
+                offset=0,
+                length=0,
+                multicast=True
+            )
+            try:
+                request_version_message = messages.build_message(messages.REQUEST_VERSION_MESSAGE, request_version_dict)
+            except construct.ConstructError:
+                # Should never occur
+                logging.critical(f"Failed to build request version message", exc_info=True)
+                return
+
+            with open(update_filepath, "r+b") as update_file:
+                decoder = fec.TransferDecoder(version, content, update_manifest, update_file, missing_chunks)
+                protocol = TransferProtocol(decoder, download_journal, self.loop)
+                transport, _ = await self.loop.create_datagram_endpoint(lambda: protocol, sock=receiver)
+                try:
+                    # The group was joined before the request, so no packet of the stream is missed
+                    self.transport.sendto(request_version_message, (server, registry.get_value(settings.PORT_REGISTRY)))
+                    logging.info(f"Receiving version {version} from the multicast transfer of {server}")
+
+                    while not protocol.finished.done():
+                        idle_time = self.loop.time() - protocol.last_packet_time
+                        if idle_time >= settings.MULTICAST_TRANSFER_IDLE:
+                            break
+                        await asyncio.wait([protocol.finished], timeout=settings.MULTICAST_TRANSFER_IDLE - idle_time)
+                finally:
+                    # Stops receiving before the update file is closed
+                    transport.close()
+
+                # The last chunk might have been cut short, keep what was received of it
+                completed_chunks = decoder.finish()
+                if len(completed_chunks) != 0:
+                    download_journal.mark_completed(completed_chunks)
+                    download_journal.save()
+
+        except socket.error:
+            logging.info("Socket error has occurred while receiving the multicast transfer")
+        finally:
+            if transport is None:
+                receiver.close()
+
+        logging.info(f"Received {missing_count - len(missing_chunks)} of {missing_count} chunks of version {version} "
+                     f"from the multicast transfer")
+
+    async def download_chunks(self, peer, version, content, update_manifest, first, last, update_file):
+        # Downloads the chunks first..last (inclusive) into the update file.
+        # Returns the chunks that were received and verified.
+        offset, _ = update_manifest.get_chunk_range(first)
+        last_offset, last_length = update_manifest.get_chunk_range(last)
+        length = last_offset + last_length - offset
+        received_chunks = []
+
+        try:
+            connection = await self.request_version(peer, version, content, offset=offset, length=length)
+        except (asyncio.TimeoutError, socket.error):
+            logging.info(f"Failed to request chunks {first}-{last} of version {version} from {peer}")
+            return received_chunks
+        if connection is None:
+            return received_chunks
+
+        reader, writer = connection
+        try:
+            for index in range(first, last + 1):
+                chunk_offset, chunk_length = update_manifest.get_chunk_range(index)
+                data = await asyncio.wait_for(reader.readexactly(chunk_length), settings.CONNECTION_TIMEOUT)
+
+                if not update_manifest.is_valid_chunk(index, data):
+                    # Skip the corrupted chunk, it will be re-fetched later
+                    logging.info(f"Chunk {index} of version {version} is corrupted")
+                    continue
+
+                update_file.seek(chunk_offset)
+                update_file.write(data)
+                received_chunks.append(index)
+        except asyncio.IncompleteReadError:
+            # The other side closed the connection
+            logging.info(f"{peer} closed the connection while sending chunks {first}-{last} of version {version}")
+        except (asyncio.TimeoutError, socket.error):
+            logging.info(f"Connection was lost while receiving chunks {first}-{last} of version {version}")
+        finally:
+            writer.close()
+
+        if len(received_chunks) != 0:
+            # The peer served verified chunks over TCP, remember it as a peer to gossip with
+            self.peers.add(peer)
+        return received_chunks
+
+    async def send_version_update(self, message, requester):
         # Check if the version file exists
         requested_version = Version(message.major, message.minor)
-        version_registry = requested_version.get_update_registry_path()
+        version_registry = requested_version.get_content_registry_path(message.content)
         if not registry.exists(version_registry):
-            # Version not exists... abort
+            # Version not exists... tell the requester, so it asks another peer right away
             logging.info(f"Version {requested_version} was requested but wasn't found in the registry")
+            self.send_not_found(requester, message.listening_port)
             return
         
         # Retrieve the update filepath
         version_filepath = registry.get_value(version_registry)
+        if message.manifest:
+            version_filepath = await self.get_version_manifest(version_filepath, requested_version)
+            if version_filepath is None:
+                self.send_not_found(requester, message.listening_port)
+                return
         try:
             update_file = open(version_filepath, "rb")
         except OSError:
             logging.error(f"Unable to open version file: {version_filepath}", exc_info=True)
+            self.send_not_found(requester, message.listening_port)
             return
 
         logging.info(f"Sending update of version {requested_version}")
-        sender = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        writer = None
         try:
             # Connect to the TCP server of the receiver
-            sender.settimeout(settings.CONNECTION_TIMEOUT)
-            sender.connect((requester[0], message.listening_port))
+            _, writer = await asyncio.wait_for(asyncio.open_connection(requester[0], message.listening_port),
+                                               settings.CONNECTION_TIMEOUT)
 
-            # Send the update file
+            # Send the requested range of the update file (zero-copy where the OS supports it)
             with update_file:
-                chunk = update_file.read(settings.VERSION_CHUNK_SIZE)
-                while len(chunk) != 0:
-                    sender.send(chunk)
-                    chunk = update_file.read(settings.VERSION_CHUNK_SIZE)
+                count = message.length if message.length != 0 else None
+                await self.loop.sendfile(writer.transport, update_file, message.offset, count)
+                await writer.drain()
 
             logging.info(f"Finished sending update of version {requested_version}")
 
-        except socket.timeout:
+        except asyncio.TimeoutError:
             # Connection was timed-out, too bad... abort
             logging.info("Connection timed out")
         except socket.error:
             # Socket error
             logging.info("Socket error has occurred")
         finally:
-            sender.shutdown(socket.SHUT_WR)
-            sender.close()
+            update_file.close()
+            if writer is not None:
+                writer.close()
+
+    def request_transfer(self, message):
+        if not settings.MULTICAST_TRANSFER_GROUP:
+            logging.info("A multicast transfer was requested, but no multicast transfer group is set")
+            return
+
+        key = (f"{message.major}.{message.minor}", int(message.content))
+        session = self.transfers.get(key)
+        if session is not None:
+            # The version is already streamed, the new receiver gets the chunks it missed in another pass
+            session.request()
+            return
+
+        session = TransferSession()
+        self.transfers[key] = session
+        task = self.spawn(self.stream_version(message, session))
+        task.add_done_callback(lambda _: self.transfers.pop(key, None))
+
+    async def stream_version(self, message, session):
+        # Streams the version once to the multicast transfer group, for all the receivers at once
+        requested_version = Version(message.major, message.minor)
+        version_registry = requested_version.get_content_registry_path(message.content)
+        if not registry.exists(version_registry):
+            logging.info(f"Version {requested_version} was requested but wasn't found in the registry")
+            return
+
+        # The version is streamed in the chunks of its manifest, so the receivers can verify every chunk
+        version_filepath = registry.get_value(version_registry)
+        manifest_path = await self.get_version_manifest(version_filepath, requested_version)
+        if manifest_path is None:
+            return
+        try:
+            update_manifest = manifest.Manifest.load(manifest_path)
+            update_file = open(version_filepath, "rb")
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.error(f"Unable to open version file: {version_filepath}", exc_info=True)
+            return
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transport = None
+        try:
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, settings.MULTICAST_TTL)
+            transport, _ = await self.loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=sender)
+
+            destination = (settings.MULTICAST_TRANSFER_GROUP, settings.MULTICAST_TRANSFER_PORT)
+            chunks_count = len(update_manifest.chunks)
+            logging.info(f"Streaming version {requested_version} to {destination[0]}")
+
+            # The stream is paced, so it doesn't overflow the buffers of the receivers (and of the switches)
+            start_time = self.loop.time()
+            sent_size = 0
+            with update_file:
+                while session.streamed < session.last_request + chunks_count:
+                    # The last chunk goes first, it holds the central directory that staging needs
+                    index = (session.streamed + chunks_count - 1) % chunks_count
+                    offset, length = update_manifest.get_chunk_range(index)
+                    data = await self.loop.run_in_executor(None, read_chunk, update_file, offset, length)
+                    for packet in fec.get_chunk_packets(message.major, message.minor, int(message.content), index,
+                                                        data):
+                        transport.sendto(packet, destination)
+                        sent_size += len(packet)
+                    session.streamed += 1
+
+                    delay = start_time + sent_size / settings.MULTICAST_TRANSFER_RATE - self.loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+            logging.info(f"Finished streaming version {requested_version} ({session.streamed} chunks)")
+        except socket.error:
+            logging.error("Unknown error while streaming version :(", exc_info=True)
+        finally:
+            update_file.close()
+            if transport is not None:
+                transport.close()
+            else:
+                sender.close()
+
+    async def get_version_manifest(self, version_filepath, version):
+        manifest_path = manifest.get_manifest_path(version_filepath)
+        if os.path.exists(manifest_path):
+            return manifest_path
+
+        if not Updater.is_server():
+            logging.info(f"Manifest of version {version} was requested but doesn't exist")
+            return None
+
+        # Only the server can sign manifests of updates that were created before manifests existed
+        logging.info(f"Creating missing manifest for version {version}")
+        update_manifest = await self.loop.run_in_executor(None, manifest.Manifest.create, version_filepath, version)
+        update_manifest.save(manifest_path)
+        return manifest_path
 
     def cleanup_listener(self):
-        self.management_socket.shutdown(2)
+        if self.multicast_transport is not None:
+            self.multicast_transport.close()
+            self.multicast_transport = None
+        elif self.multicast_socket is not None:
+            self.multicast_socket.close()
+        self.multicast_socket = None
+
+        if self.transport is not None:
+            # Closing the transport closes the management socket as well
+            self.transport.close()
+            self.transport = None
+            return
+
         self.management_socket.close()
 
     def __del__(self):
-        self.cleanup_listener()
+        if self.management_socket is not None and self.management_socket.fileno() != -1:
+            self.cleanup_listener()
+
+
+def init_registry():
+    # Sets the registry values that don't exist yet to their defaults
+    if not registry.exists(settings.REGISTRY_PATH):
+        registry.create_key(settings.REGISTRY_PATH)
+    with registry.batch():
+        if not registry.exists(settings.AUTO_INSTALLATIONS_REGISTRY):
+            registry.set_value(settings.AUTO_INSTALLATIONS_REGISTRY, settings.AUTO_INSTALLATIONS)
+        if not registry.exists(settings.UPDATING_SERVER_REGISTRY):
+            registry.set_value(settings.UPDATING_SERVER_REGISTRY, settings.UPDATING_SERVER)
+        if not registry.exists(settings.PORT_REGISTRY):
+            registry.set_value(settings.PORT_REGISTRY, settings.PORT)
+        # The keys are part of the settings the installer created (without them no announcement is accepted)
+        if signing.get_scheme() == signing.SignatureScheme.RSA:
+            if not registry.exists(settings.RSA_MODULO_REGISTRY) and hasattr(settings, "RSA_MODULO"):
+                registry.set_value(settings.RSA_MODULO_REGISTRY, settings.RSA_MODULO)
+            if not registry.exists(settings.RSA_PUBLIC_REGISTRY) and hasattr(settings, "PUBLIC_KEY"):
+                registry.set_value(settings.RSA_PUBLIC_REGISTRY, settings.PUBLIC_KEY)
+        elif not registry.exists(settings.ED25519_PUBLIC_REGISTRY) and hasattr(settings, "ED25519_PUBLIC_KEY"):
+            registry.set_value(settings.ED25519_PUBLIC_REGISTRY, settings.ED25519_PUBLIC_KEY)
+        if not registry.exists(settings.UPDATE_MAJOR_REGISTRY):
+            registry.set_value(settings.UPDATE_MAJOR_REGISTRY, settings.UPDATE_MAJOR)
+        if not registry.exists(settings.UPDATE_MINOR_REGISTRY):
+            registry.set_value(settings.UPDATE_MINOR_REGISTRY, settings.UPDATE_MINOR)
+        if not registry.exists(settings.VERSION_MAJOR_REGISTRY):
+            registry.set_value(settings.VERSION_MAJOR_REGISTRY, settings.VERSION_MAJOR)
+        if not registry.exists(settings.VERSION_MINOR_REGISTRY):
+            registry.set_value(settings.VERSION_MINOR_REGISTRY, settings.VERSION_MINOR)
+        if not registry.exists(settings.ADDRESS_ID_REGISTRY):
+            registry.set_value(settings.ADDRESS_ID_REGISTRY, settings.ADDRESS_ID)
+        if not registry.exists(settings.SETTINGS_REGISTRY):
+            registry.set_value(settings.SETTINGS_REGISTRY, settings.SETTINGS_PATH)
+
+
+def main():
+    # Runs the updater as a plain process (without the windows service)
+    settings.init_settings(save=False)
+    init_registry()
+    os.makedirs(settings.UPDATER_PATH, exist_ok=True)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)-19s [%(levelname)-8s] %(funcName)-21s | %(message)s",
+                        datefmt="%d.%m.%Y %H:%M:%S")
+
+    updater = Updater()
+    try:
+        updater.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()